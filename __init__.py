@@ -8,15 +8,19 @@ __license__ = 'GPL v3'
 __copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
 __docformat__ = 'restructuredtext en'
 
-import time
 from urllib import quote
+from urlparse import urljoin
 
 from lxml.html import fromstring, tostring
 
 from calibre import as_unicode
-from calibre.ebooks.metadata.sources.base import Source
+from calibre.ebooks.metadata.sources.base import Source, Option
 from calibre.utils.cleantext import clean_ascii_chars
 
+# Search hits scoring lower than this against the book being identified are
+# not downloaded
+MIN_CANDIDATE_SCORE = 0.6
+
 class BeamEbooks(Source):
 
     name = 'Beam Ebooks'
@@ -26,8 +30,7 @@ class BeamEbooks(Source):
     version = (1, 1, 0)
     minimum_calibre_version = (0, 8, 4)
 
-    capabilities = frozenset(['identify'])
-        # , 'cover'
+    capabilities = frozenset(['identify', 'cover'])
     touched_fields = frozenset(['identifier:beam-ebooks',
                                 'title',
                                 'authors'])
@@ -41,6 +44,81 @@ class BeamEbooks(Source):
 
     supports_gzip_transfer_encoding = True
 
+    options = (
+            Option('cache_ttl_days', 'number', 30,
+                _('Days to keep downloaded pages:'),
+                _('Book pages downloaded from Beam Ebooks are reused for this '
+                  'many days before they are downloaded again.')),
+            Option('cache_max_entries', 'number', 5000,
+                _('Maximum number of cached pages:'),
+                _('The least recently used pages are dropped from the cache '
+                  'once it holds more than this many.')),
+            Option('search_cache_ttl_days', 'number', 7,
+                _('Days to remember search results:'),
+                _('A title that was found on Beam Ebooks is not searched for '
+                  'again for this many days.')),
+            Option('search_miss_ttl_hours', 'number', 12,
+                _('Hours to remember failed searches:'),
+                _('A title that was not found on Beam Ebooks is not searched '
+                  'for again for this many hours.')),
+            Option('cover_cache_mb', 'number', 100,
+                _('Megabytes of covers to keep:'),
+                _('Downloaded covers are kept on disk up to this size, the '
+                  'least recently used ones are removed first.')),
+            Option('missing_ttl_hours', 'number', 24,
+                _('Hours to remember missing books:'),
+                _('A beam ebooks id the site does not know is not asked for '
+                  'again for this many hours.')),
+            Option('pool_size', 'number', 4,
+                _('Simultaneous downloads:'),
+                _('Number of book pages downloaded from Beam Ebooks at the same '
+                  'time, shared by all books being identified.')),
+            Option('requests_per_minute', 'number', 120,
+                _('Requests per minute:'),
+                _('Upper limit for requests sent to Beam Ebooks, shared by all '
+                  'books being identified.')),
+            Option('max_connections', 'number', 4,
+                _('Connections kept open:'),
+                _('Number of connections to Beam Ebooks that are kept open '
+                  'and reused, shared by all books being identified.')),
+            Option('use_event_loop', 'bool', False,
+                _('Download on a single event loop thread'),
+                _('Runs all downloads from one thread instead of one worker '
+                  'thread per download, for identifying many books at once.')),
+            Option('hedge_requests', 'bool', True,
+                _('Hedge slow requests and searches that find nothing'),
+                _('Requests that take longer than most requests to Beam '
+                  'Ebooks do are sent a second time. When the title search '
+                  'is slow or finds nothing, searches for the title together '
+                  'with the author and for the author alone are tried as '
+                  'well. The first answer wins.')),
+            Option('max_candidates', 'number', 3,
+                _('Search results to download:'),
+                _('Number of the best matching search results whose book '
+                  'pages are downloaded for each book.')),
+            Option('prefetch_issues', 'number', 3,
+                _('Perry Rhodan issues to prefetch:'),
+                _('After a Perry Rhodan issue has been identified, the pages '
+                  'of this many following issues are downloaded in the '
+                  'background, with requests left over from the rate limit.')),
+            Option('title_rules', 'string', '',
+                _('Extra title rules:'),
+                _('Rules that rewrite the titles found on Beam Ebooks, tried '
+                  'before the built-in Perry Rhodan rules. Each rule is a '
+                  'regular expression and a replacement like '
+                  'PR{issue:04d} - {title}, separated by =>, where issue and '
+                  'title are named groups of the expression. Separate rules '
+                  'with ;;')),
+            Option('use_catalog', 'bool', True,
+                _('Look up titles in the local catalog first'),
+                _('Books identified once are kept in a local catalog, titles '
+                  'found there need no search on Beam Ebooks.')),
+            Option('enable_tracing', 'bool', False,
+                _('Log timings of each lookup phase'),
+                _('Collects how long queries, downloads and parsing take and '
+                  'writes histograms of them to the log after each lookup.')),
+            )
+
     BASE_URL = 'http://www.beam-ebooks.de'
 
     def get_book_url(self, identifiers):
@@ -55,10 +133,8 @@ class BeamEbooks(Source):
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
         '''
-        print("identify")
-        print("    Title: ", title)
-        print("    Authors: ", authors)
-        print("    Identifiers are: ", identifiers)
+        from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+        tracer = get_tracer(self)
 
         matches = []
         # Unlike the other metadata sources, and like the Goodreads source,
@@ -67,105 +143,276 @@ class BeamEbooks(Source):
         # URL for that book.
         br = self.browser
         beam_ebooks_id = identifiers.get('beam-ebooks', None)
-        if beam_ebooks_id:
-            print("    Found Beam ID %s" % (beam_ebooks_id))
-            matches.append('%s/ebook/%s' % (BeamEbooks.BASE_URL, beam_ebooks_id))
-        else:
-            query = self._create_query(log, title=title, authors=authors, identifiers=identifiers)
-            if query is None:
+        query = None
+        if not beam_ebooks_id:
+            with tracer.phase('query_build'):
+                queries = self._create_queries(log, title=title, authors=authors, identifiers=identifiers)
+            if not queries:
                 log.error("    Insufficient metadata to construct query")
                 return
+            query = queries[0][1]
 
-            try:
-                log.info("    Querying: %s" % query)
-                print("    Querying: %s" % query)
-                response = br.open_novisit(query, timeout=timeout)
-                location = response.geturl()
-                log.info("    Redirected to: %r" % location)
-                matches.append(location)
+        if self.prefs['use_event_loop']:
+            from calibre_plugins.beam_ebooks_metadata.eventloop import identify
+            err = identify(self, log, result_queue, abort, query, title, authors,
+                           beam_ebooks_id, timeout)
+            self._log_stats(log)
+            return err
 
-                try:
-                    raw = response.read().strip()
-                    # open('D:\\work\\calibre-dump.html', 'wb').write(raw)
-                    raw = raw.decode('utf-8', errors='replace')
-                    if not raw:
-                        log.error("    Failed to get raw result for query: %r" % query)
-                        return
-                    root = fromstring(clean_ascii_chars(raw))
-                except:
-                    msg = "    Failed to parse beam ebooks page for query: %r" % query
-                    log.exception(msg)
-                    print(msg)
-                    return msg
-
-                # Now grab the first value from the search results, provided the
-                # title and authors appear to be for the same book
-                self._parse_search_results(log, title, authors, root, matches, timeout)
-
-            except Exception as e:
-                err = "    Failed to make identify query: %r" % query
-                log.exception(err)
-                return as_unicode(e)
+        if beam_ebooks_id:
+            matches.append('%s/ebook/%s' % (BeamEbooks.BASE_URL, beam_ebooks_id))
+        elif self.prefs['hedge_requests']:
+            from calibre_plugins.beam_ebooks_metadata.planner import QueryPlanner
+            err = QueryPlanner(self, log, abort, timeout).run(queries, title, authors, matches)
+            if err is not None:
+                return err
+        else:
+            err = self._search(log, query, title, authors, abort, timeout, matches)
+            if err is not None:
+                return err
 
         if abort.is_set():
             return
 
-        print("    Matches are: ", matches)
-        log.info("    Matches are: ", matches)
+        log.debug("    Matches are: %s" % matches)
 
+        from calibre_plugins.beam_ebooks_metadata.pool import get_pool, Completion
         from calibre_plugins.beam_ebooks_metadata.worker import Worker
-        workers = [Worker(url, result_queue, br, log, i, self) for i, url in enumerate(matches)]
-
+        completion = Completion(len(matches))
+        workers = [Worker(url, result_queue, br, log, i, self, abort=abort,
+                          completion=completion, exact=bool(beam_ebooks_id) and i == 0)
+                   for i, url in enumerate(matches)]
+
+        # The shared rate limiter spaces out the requests, across all
+        # identify calls running at the same time
+        pool = get_pool(self)
         for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
-
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
-                    break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
-                break
+            pool.submit(w.run)
+
+        # Returns once every worker is done, the exact id match has been
+        # found, or abort is set
+        completion.wait(abort)
 
+        self._log_stats(log)
         return None
+
+    def _log_stats(self, log):
+        from calibre_plugins.beam_ebooks_metadata.cache import get_details_cache, get_search_cache
+        log.info("    %s" % get_details_cache(self).stats())
+        log.info("    %s" % get_search_cache(self).stats())
+        if self.prefs['use_event_loop']:
+            from calibre_plugins.beam_ebooks_metadata.eventloop import get_event_loop
+            log.info("    %s" % get_event_loop(self).stats())
+        from calibre_plugins.beam_ebooks_metadata.transport import get_transport
+        log.info("    %s" % get_transport(self).stats())
+        from calibre_plugins.beam_ebooks_metadata.health import get_site_health
+        log.info("    %s" % get_site_health().stats())
+        from calibre_plugins.beam_ebooks_metadata.pool import get_single_flight
+        log.info("    %s" % get_single_flight().stats())
+        from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+        get_tracer(self).dump(log)
     
 
-    def _create_query(self, log, title=None, authors=None, identifiers={}):
-        log("create_query")
-        log("Title: ", title)
-        log("Authors: ", authors)
-        log("Identifiers: ", identifiers)
+    def get_cached_cover_url(self, identifiers):
+        url = None
+        beam_ebooks_id = identifiers.get('beam-ebooks', None)
+        if beam_ebooks_id is not None:
+            url = self.cached_identifier_to_cover_url(beam_ebooks_id)
+        return url
+
+    def download_cover(self, log, result_queue, abort, title=None, authors=None,
+                       identifiers={}, timeout=30, get_best_cover=False):
+        cached_url = self.get_cached_cover_url(identifiers)
+        if cached_url is None:
+            log.info('No cached cover found, running identify')
+            from Queue import Queue, Empty
+            rq = Queue()
+            self.identify(log, rq, abort, title=title, authors=authors,
+                          identifiers=identifiers)
+            if abort.is_set():
+                return
+            results = []
+            while True:
+                try:
+                    results.append(rq.get_nowait())
+                except Empty:
+                    break
+            results.sort(key=self.identify_results_keygen(
+                title=title, authors=authors, identifiers=identifiers))
+            for mi in results:
+                cached_url = self.get_cached_cover_url(mi.identifiers)
+                if cached_url is not None:
+                    break
+        if cached_url is None:
+            log.info('No cover found')
+            return
+
+        if abort.is_set():
+            return
+        log.debug('Downloading cover from: %s' % cached_url)
+        from calibre_plugins.beam_ebooks_metadata.covers import get_cover_cache
+        covers = get_cover_cache(self)
+        cdata = covers.fetch(self, log, cached_url, abort, timeout=timeout)
+        log.info('    %s' % covers.stats())
+        if cdata is not None:
+            result_queue.put((self, cdata))
+
+    def bulk_identify(self, log, books, abort=None, timeout=30):
+        '''
+        Identifies many (title, authors, identifiers) tuples at once, see
+        :class:`calibre_plugins.beam_ebooks_metadata.bulk.BulkIdentify`.
+        Returns the list of Metadata objects found for each book.
+        '''
+        from calibre_plugins.beam_ebooks_metadata.bulk import bulk_identify
+        return bulk_identify(self, log, books, abort=abort, timeout=timeout)
+
+    def bulk_identify_stream(self, log, books, abort=None, timeout=30):
+        '''
+        Like :meth:`bulk_identify`, but a generator of (index, Metadata list)
+        pairs handed out as soon as each book is done, for libraries too large
+        to keep every result in memory. books can be any iterable. Pass it to
+        :func:`calibre_plugins.beam_ebooks_metadata.bulk.write_ndjson` to
+        write the results out as they come.
+        '''
+        from calibre_plugins.beam_ebooks_metadata.bulk import BulkIdentify
+        return BulkIdentify(self, log, abort=abort, timeout=timeout).stream(books)
+
+    def refresh_library(self, log, beam_ebooks_ids, result_queue, abort=None,
+                        timeout=30, resume=True):
+        '''
+        Checks the details pages of the given beam ebooks ids for changes and
+        puts the Metadata of the changed books on result_queue, see
+        :class:`calibre_plugins.beam_ebooks_metadata.refresh.LibraryRefresh`.
+        An interrupted refresh continues where it stopped unless resume is
+        False. Returns the number of changed books.
+        '''
+        from calibre_plugins.beam_ebooks_metadata.refresh import LibraryRefresh
+        return LibraryRefresh(self, log, abort=abort, timeout=timeout).run(
+                beam_ebooks_ids, result_queue, resume=resume)
+
+    def _search(self, log, query, title, authors, abort, timeout, matches):
+        '''
+        Looks up the title in the local catalog, or else runs the search
+        query or takes its result from the search cache, and appends the
+        urls found to matches. Returns an error message if the search failed.
+        '''
+        from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+        tracer = get_tracer(self)
+
+        if self._search_cached(log, query, title, authors, matches):
+            return None
+
+        from calibre_plugins.beam_ebooks_metadata.health import CircuitOpen
+
+        try:
+            log.debug("    Querying: %s" % query)
+            tracer.count('search_request')
+            from calibre_plugins.beam_ebooks_metadata.worker import shared_fetch
+            fetched = shared_fetch(self, query, timeout, abort, 'search_fetch')
+            if fetched is None:
+                return None
+            (location, raw) = fetched
+
+            return self._search_downloaded(log, query, title, authors,
+                    location, raw, timeout, matches)
+
+        except CircuitOpen as e:
+            log.error("    %s, search skipped: %r" % (e, query))
+            return as_unicode(e)
+        except Exception as e:
+            err = "    Failed to make identify query: %r" % query
+            log.exception(err)
+            return as_unicode(e)
+
+    def _search_cached(self, log, query, title, authors, matches):
+        '''
+        Answers the search from the local catalog or the search cache if
+        possible. Returns True if the urls found were appended to matches.
+        '''
+        from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+        tracer = get_tracer(self)
+
+        from calibre_plugins.beam_ebooks_metadata.catalog import disable_catalog, get_catalog, use_catalog
+        if use_catalog(self):
+            try:
+                found = get_catalog().lookup(title, authors)
+            except:
+                disable_catalog(log)
+                found = []
+            if found:
+                tracer.count('catalog_hit')
+                log.debug("    Found in local catalog: %s" % ', '.join(found))
+                matches.extend('%s/ebook/%s' % (BeamEbooks.BASE_URL, beam_ebooks_id)
+                               for beam_ebooks_id in found)
+                return True
+
+        from calibre_plugins.beam_ebooks_metadata.cache import get_search_cache
+        try:
+            cached = get_search_cache(self).get(query)
+        except:
+            log.exception("    Error reading the search cache, searching: %r" % query)
+            cached = None
+        if cached is not None:
+            tracer.count('search_cache_hit')
+            log.debug("    Search cache hit for: %s" % query)
+            (location, hits) = cached
+            self._match_search(log, title, authors, location, hits, matches)
+            return True
+        return False
+
+    def _search_downloaded(self, log, query, title, authors, location, raw, timeout, matches):
+        '''
+        Parses the downloaded search result page, remembers its hits in the
+        search cache and appends the urls of those matching the book to
+        matches. Returns an error message if the page could not be parsed.
+        '''
+        from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+        with get_tracer(self).phase('search_parse'):
+            try:
+                raw = raw.strip()
+                # open('D:\\work\\calibre-dump.html', 'wb').write(raw)
+                raw = raw.decode('utf-8', errors='replace')
+                if not raw:
+                    log.error("    Failed to get raw result for query: %r" % query)
+                    return None
+                root = fromstring(clean_ascii_chars(raw))
+            except:
+                msg = "    Failed to parse beam ebooks page for query: %r" % query
+                log.exception(msg)
+                return msg
+
+            hits = list(self._search_hits(root))
+
+        # The redirect target may just be the search result page itself,
+        # only a details page is worth remembering
+        if location.find("/ebook/") == -1:
+            location = None
+        from calibre_plugins.beam_ebooks_metadata.cache import get_search_cache
+        try:
+            get_search_cache(self).put(query, location, hits)
+        except:
+            log.exception("    Error writing the search cache: %r" % query)
+        self._match_search(log, title, authors, location, hits, matches)
+        return None
 
+    def _create_query(self, log, title=None, authors=None, identifiers={}):
         q = None
         
         # http://www.beam-ebooks.de/suchergebnis.php?Type=Title&sw=Thanatos&x=0&y=0
         if q == None:
             if title != None:
                 # Special handling for Perry Rhodan files
-                if title.startswith("PR"):
-                    # title = title.encode('utf-8') if isinstance(title, unicode) else title
-                    index_of_dash = title.find(" - ")
-                    if index_of_dash > -1:
-                        # title = title[:index_of_dash]
-                        index_of_dash = index_of_dash + 3
-                        title = title[index_of_dash:]
-                    else:
-                        # Try without spaces, for the old convention
-                        if len(title) > 6:
-                            if title[6] == '-':
-                                title = title[7:]
-
-                    msg = "    Perry Rhodan, modified title: %s" % (title)
-                    log.info(msg)
-                    print(msg)
+                from calibre_plugins.beam_ebooks_metadata.titles import query_rules
+                (title, issue) = query_rules.apply(title)
+                if issue is not None:
+                    log.debug("    Perry Rhodan, modified title: %s" % (title))
 
+                # Collapse whitespace, so equivalent titles share one search cache entry
+                title = ' '.join(title.split())
                 # title = title.encode('utf-8') if isinstance(title, unicode) else title
-                title = title.encode('iso-8859-1')
+                # The site speaks latin-1, characters like the en dash
+                # become ? instead of failing the lookup
+                title = title.encode('iso-8859-1', 'replace')
                 q = '%s/suchergebnis.php?Type=Title&sw=%s&x=0&y=0' % (BeamEbooks.BASE_URL, quote(title))
 
         # Not sure if searching for authors is a good idea here...
@@ -178,35 +425,88 @@ class BeamEbooks(Source):
 
         return q
 
-    def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout):
-        url = None
-
+    def _create_queries(self, log, title=None, authors=None, identifiers={}):
+        '''
+        The searches worth running for a book, as (strategy, query) pairs with
+        the most promising first: the title search of :meth:`_create_query`,
+        then, if authors are known, a search of all fields for the title and
+        the last name of the first author, and a search for that author.
+        '''
+        query = self._create_query(log, title=title, authors=authors, identifiers=identifiers)
+        if query is None:
+            return []
+        queries = [('title', query)]
+        if authors:
+            from calibre_plugins.beam_ebooks_metadata.titles import query_rules
+            words = ' '.join(query_rules.apply(title)[0].split())
+            author = ' '.join(authors[0].split())
+            last_name = author.split(' ')[-1]
+            # http://www.beam-ebooks.de/suchergebnis.php?Type=&sw=Thanatos+Borsch&x=0&y=0
+            queries.append(('combined', '%s/suchergebnis.php?Type=&sw=%s&x=0&y=0' % (
+                BeamEbooks.BASE_URL, quote(('%s %s' % (words, last_name)).encode('iso-8859-1', 'replace')))))
+            # http://www.beam-ebooks.de/suchergebnis.php?Type=Author&sw=Uwe+Anton&x=0&y=0
+            queries.append(('author', '%s/suchergebnis.php?Type=Author&sw=%s&x=0&y=0' % (
+                BeamEbooks.BASE_URL, quote(author.encode('iso-8859-1', 'replace')))))
+        return queries
+
+    def _search_hits(self, root):
+        '''
+        Yields (url, title, author) for every book on a search result page
+        '''
+        # Every hit is a div with the author in bold, followed by the link to
+        # the book, sometimes with a p tag in between
         # <div CLASS='stil2'> <b>Leo Lukas</b><br><a href='/ebook/19938'><b>PERRY RHODAN-Heftroman 2601: Galaxis in Aufruhr</b></a><br><i>Die ersten Tage in Chanda - Landung auf der Mysteriösen Glutwelt</i></DIV>
-        if url == None:
-            first_result = root.xpath('//div[@class="stil2"]/a')
-            if first_result:
-                url = first_result[0].get('href').strip()
-            else:
-                print("First pattern, no ebook line found")
-
-        # Try with an p tag in between
         # <div CLASS='stil2'> <b>K. H. Scheer</b><br><a href='/ebook/15156'><b>Der Einsame der Zeit - Perry Rhodan 50</b></a><br><i>Anfang eines neuen, faszinierenden Abenteuers – Höhepunkt der Perry-Rhodan-Serie</i></DIV> 
-        if url == None:
-            first_result = root.xpath('//div[@class="stil2"]/p/a')
-            if first_result:
-                url = first_result[0].get('href').strip()
-            else:
-                print("First pattern, no ebook line found")
+        for div in root.xpath('//div[@class="stil2"]'):
+            links = div.xpath('./a | ./p/a')
+            if not links:
+                continue
+            url = (links[0].get('href') or '').strip()
+            if url.find("/ebook/") == -1:
+                continue
+            author = div.xpath('./b | ./p/b')
+            author = author[0].text_content().strip() if author else None
+            title = links[0].text_content().strip()
+            yield (urljoin(BeamEbooks.BASE_URL, url), title, author)
+
+    def _match_search(self, log, orig_title, orig_authors, location, hits, matches):
+        '''
+        Appends the details page the site went straight to, and the hits
+        of the search whose title and authors appear to be for the same
+        book, to matches
+        '''
+        from calibre_plugins.beam_ebooks_metadata.scoring import score_candidate
+
+        if location is not None and location not in matches:
+            matches.append(location)
+        candidates = []
+        for (url, title, author) in hits:
+            score = score_candidate(orig_title, orig_authors, title, author)
+            log.debug("    Candidate %.2f: %s (%s)" % (score, title, author))
+            candidates.append((score, len(candidates), url))
+
+        if not candidates:
+            log.debug("    No ebook line found")
+            return
 
-        if url.find("/ebook/") > -1:
-            result_url = "%s/%s" % (BeamEbooks.BASE_URL, url)
-            matches.append(result_url)
+        # Only the best few candidates are worth a details download, in
+        # order of relevance
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+        best = [c for c in candidates if c[0] >= MIN_CANDIDATE_SCORE]
+        for (score, position, url) in best[:int(self.prefs['max_candidates'])]:
+            if url not in matches:
+                matches.append(url)
 
 
 if __name__ == '__main__': # tests
     # To run these test use:
     # calibre-debug -e __init__.py
     from calibre.ebooks.metadata.sources.test import (test_identify_plugin, title_test, authors_test, series_test)
+
+    # Titles of the new naming convention, padded to four digits
+    from calibre_plugins.beam_ebooks_metadata.titles import DETAILS_RULES, TitleRules
+    assert TitleRules(DETAILS_RULES).apply('PERRY RHODAN-Heftroman 123: Titel') == ('PR0123 - Titel', 123)
+
     test_identify_plugin(BeamEbooks.name,
         [
             (
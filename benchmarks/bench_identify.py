@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+# Offline benchmarks against the recorded pages in benchmarks/corpus, served
+# by the local stand-in server: identify latency percentiles, bulk
+# throughput, library refresh times, the parse cost per details page and
+# the peak memory use. Run with the plugin installed:
+#
+#     calibre-debug -e benchmarks/bench_identify.py -- --latency 100 --rounds 5
+
+import os
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+from Queue import Queue
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin import StandinServer, CORPUS
+
+# Keep the benchmark away from the caches of the calibre installation, this
+# has to happen before the plugin opens them
+os.environ['BEAM_EBOOKS_CACHE'] = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+
+from lxml.html import fromstring
+
+from calibre.utils.logging import ThreadSafeLog, ERROR, INFO
+
+from calibre_plugins.beam_ebooks_metadata import BeamEbooks
+from calibre_plugins.beam_ebooks_metadata.bulk import write_ndjson
+from calibre_plugins.beam_ebooks_metadata.eventloop import get_event_loop
+from calibre_plugins.beam_ebooks_metadata.health import get_site_health
+from calibre_plugins.beam_ebooks_metadata.pool import get_single_flight
+from calibre_plugins.beam_ebooks_metadata.titles import get_details_rules
+from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+from calibre_plugins.beam_ebooks_metadata.transport import get_transport
+from calibre_plugins.beam_ebooks_metadata.worker import Worker, cut_details, extract_details
+
+
+def make_plugin(warm, trace, event_loop, hedge):
+    prefs = dict((o.name, o.default) for o in BeamEbooks.options)
+    if not warm:
+        # Entries older than zero days are never used, so every lookup
+        # goes to the stand-in server
+        prefs.update(cache_ttl_days=0, search_cache_ttl_days=0,
+                     search_miss_ttl_hours=0, missing_ttl_hours=0, use_catalog=False,
+                     prefetch_issues=0)
+    # Benchmarks are not limited by the politeness budget for the real site
+    prefs.update(requests_per_minute=60 * 1000, pool_size=8, max_connections=8,
+                 enable_tracing=trace, use_event_loop=event_loop, hedge_requests=hedge)
+    plugin_class = type(str('BenchBeamEbooks'), (BeamEbooks,), {'prefs': prefs})
+    return plugin_class(None)
+
+
+def load_books(corpus):
+    books = []
+    with open(os.path.join(corpus, 'books.txt'), 'rb') as f:
+        for line in f.read().decode('utf-8').splitlines():
+            if not line.strip() or line.startswith('#'):
+                continue
+            (title, authors, beam_ebooks_id) = [x.strip() for x in line.split('|')]
+            authors = [a.strip() for a in authors.split('&')] if authors else None
+            identifiers = {'beam-ebooks': beam_ebooks_id} if beam_ebooks_id else {}
+            books.append((title or None, authors, identifiers))
+    return books
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    (lower, upper) = (int(k), min(int(k) + 1, len(values) - 1))
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def report_latencies(name, latencies):
+    print('%-22s n=%-5d p50 %7.1f ms  p90 %7.1f ms  p99 %7.1f ms  max %7.1f ms' % (
+        name, len(latencies),
+        percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+        percentile(latencies, 99) * 1000, max(latencies or [0]) * 1000))
+
+
+def bench_identify(plugin, log, books, rounds, timeout):
+    latencies = []
+    for i in range(rounds):
+        for (title, authors, identifiers) in books:
+            start = time.time()
+            plugin.identify(log, Queue(), Event(), title=title,
+                    authors=authors, identifiers=identifiers, timeout=timeout)
+            latencies.append(time.time() - start)
+    report_latencies('identify', latencies)
+
+
+def bench_concurrent(plugin, log, books, threads, server, timeout):
+    # Every book is identified by several threads at the same moment, the
+    # way calibre's bulk download does it for duplicates in a library
+    requests = server.requests
+    start = time.time()
+    for (title, authors, identifiers) in books:
+        callers = [Thread(target=plugin.identify, args=(log, Queue(), Event()),
+                          kwargs=dict(title=title, authors=authors,
+                                      identifiers=identifiers, timeout=timeout))
+                   for i in range(threads)]
+        for t in callers:
+            t.start()
+        for t in callers:
+            t.join()
+    elapsed = time.time() - start
+    print('%-22s %d x %d calls in %.2f s, %d requests' % (
+        'concurrent identify', len(books), threads, elapsed, server.requests - requests))
+
+
+def bench_bulk(plugin, log, books, copies, timeout):
+    # Copies of the same book are merged by bulk_identify, so every copy
+    # gets an id of its own that the stand-in answers with its 404 page
+    batch = []
+    for i in range(copies):
+        for (title, authors, identifiers) in books:
+            if i > 0:
+                identifiers = {'beam-ebooks': '9%05d' % len(batch)}
+            batch.append((title, authors, identifiers))
+    # Streamed the way a large library would be, nothing is kept
+    start = time.time()
+    with open(os.devnull, 'wb') as f:
+        write_ndjson(plugin.bulk_identify_stream(log, batch, timeout=timeout), f)
+    elapsed = time.time() - start
+    print('%-22s %d books in %.2f s, %.1f books/s' % (
+        'bulk_identify', len(batch), elapsed, len(batch) / max(elapsed, 1e-9)))
+
+
+def bench_refresh(plugin, log, corpus, timeout):
+    # Every recorded details page is refreshed twice, the second run finds
+    # them all unchanged and the stand-in answers with 304 for the ETag it
+    # sent the first time
+    ids = [name[len('ebook_'):-len('.html')] for name in sorted(os.listdir(corpus))
+           if name.startswith('ebook_')]
+    for name in ('refresh', 'refresh again'):
+        start = time.time()
+        changed = plugin.refresh_library(log, ids, Queue(), timeout=timeout)
+        elapsed = time.time() - start
+        print('%-22s %d books in %.2f s, %d changed' % (name, len(ids), elapsed, changed))
+
+
+def bench_parse(plugin, log, corpus, repeat):
+    worker = Worker('', Queue(), plugin.browser, log, 0, plugin)
+    data = []
+    for name in sorted(os.listdir(corpus)):
+        if name.startswith('ebook_'):
+            with open(os.path.join(corpus, name), 'rb') as f:
+                data.append(f.read())
+    pages = [raw.decode('iso-8859-1') for raw in data]
+    timings = {'fromstring': 0.0, 'parse_title': 0.0, 'parse_authors': 0.0}
+    for i in range(repeat):
+        for raw in pages:
+            start = time.time()
+            root = fromstring(raw)
+            parsed = time.time()
+            worker.parse_title(root)
+            titled = time.time()
+            worker.parse_authors(root)
+            done = time.time()
+            timings['fromstring'] += parsed - start
+            timings['parse_title'] += titled - parsed
+            timings['parse_authors'] += done - titled
+    n = len(pages) * repeat
+    for name in ('fromstring', 'parse_title', 'parse_authors'):
+        print('%-22s %8.1f us/page' % (name, timings[name] / max(n, 1) * 1e6))
+
+    # The pages as far as read_details() downloads them
+    cut = [cut_details(raw).decode('iso-8859-1') for raw in data]
+    start = time.time()
+    for i in range(repeat):
+        for raw in cut:
+            fromstring(raw)
+    elapsed = time.time() - start
+    print('%-22s %8.1f us/page, %d of %d bytes read' % ('fromstring (cut)',
+        elapsed / max(n, 1) * 1e6, sum(len(raw) for raw in cut),
+        sum(len(raw) for raw in pages)))
+
+    # The raw titles of the corpus, rewritten one batch at a time
+    titles = [extract_details(fromstring(raw))[0] for raw in pages]
+    rules = get_details_rules(plugin, log)
+    start = time.time()
+    for i in range(repeat):
+        rules.apply_many(titles)
+    elapsed = time.time() - start
+    print('%-22s %8.1f us/title' % ('title rules', elapsed / max(n, 1) * 1e6))
+
+
+def peak_rss():
+    '''
+    The peak resident set size of the benchmark in MB, or None where the
+    resource module does not exist
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on OS X
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def option_parser():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--corpus', default=CORPUS)
+    parser.add_option('--latency', type='float', default=50,
+            help='Milliseconds the stand-in waits before answering')
+    parser.add_option('--jitter', type='float', default=20)
+    parser.add_option('--error-rate', type='float', default=0)
+    parser.add_option('--timeout-rate', type='float', default=0)
+    parser.add_option('--timeout', type='float', default=5,
+            help='Seconds the plugin waits for an answer')
+    parser.add_option('--rounds', type='int', default=3)
+    parser.add_option('--bulk-copies', type='int', default=10)
+    parser.add_option('--threads', type='int', default=4,
+            help='Threads identifying the same book at once')
+    parser.add_option('--parse-repeat', type='int', default=200)
+    parser.add_option('--warm', action='store_true', default=False,
+            help='Keep the page caches and catalog enabled')
+    parser.add_option('--event-loop', action='store_true', default=False,
+            help='Download on the event loop instead of the worker threads')
+    parser.add_option('--no-hedge', action='store_false', dest='hedge', default=True,
+            help='Send every request once and run only the title search')
+    parser.add_option('--trace', action='store_true', default=False,
+            help='Print the time spent in each lookup phase at the end')
+    return parser
+
+
+def main(args):
+    (opts, args) = option_parser().parse_args(args[1:])
+    server = StandinServer(0, opts.corpus, opts.latency / 1000.0,
+            opts.jitter / 1000.0, opts.error_rate, opts.timeout_rate,
+            hang=opts.timeout * 2).start()
+    BeamEbooks.BASE_URL = server.base_url
+
+    plugin = make_plugin(opts.warm, opts.trace, opts.event_loop, opts.hedge)
+    log = ThreadSafeLog(level=ERROR)
+    books = load_books(opts.corpus)
+
+    print('Stand-in at %s, latency %.0f+%.0f ms, %.0f%% errors, %.0f%% timeouts' % (
+        server.base_url, opts.latency, opts.jitter,
+        opts.error_rate * 100, opts.timeout_rate * 100))
+    bench_identify(plugin, log, books, opts.rounds, opts.timeout)
+    bench_concurrent(plugin, log, books, opts.threads, server, opts.timeout)
+    bench_bulk(plugin, log, books, opts.bulk_copies, opts.timeout)
+    bench_refresh(plugin, log, opts.corpus, opts.timeout)
+    bench_parse(plugin, log, opts.corpus, opts.parse_repeat)
+    print('%-22s %d' % ('requests served', server.requests))
+    print('%-22s %s' % ('connections', get_transport(plugin).stats()))
+    print('%-22s %s' % ('site', get_site_health().stats()))
+    print('%-22s %s' % ('single flight', get_single_flight().stats()))
+    rss = peak_rss()
+    if rss is not None:
+        print('%-22s %.1f MB' % ('peak RSS', rss))
+    get_transport(plugin).close()
+    if opts.event_loop:
+        print('%-22s %s' % ('event loop', get_event_loop(plugin).stats()))
+    get_tracer(plugin).dump(ThreadSafeLog(level=INFO), totals=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
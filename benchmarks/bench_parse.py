@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+# Pages per second for extracting title and authors from saved Beam Ebooks
+# details pages, comparing the old three-scan extraction with the
+# precompiled single pass in worker.extract_details. Run with the plugin
+# installed:
+#
+#     calibre-debug -e benchmarks/bench_parse.py -- <directory with saved pages>
+
+import os
+import sys
+import time
+
+from lxml.html import fromstring
+
+from calibre_plugins.beam_ebooks_metadata.worker import extract_details
+
+
+def legacy_extract(root):
+    # The extraction as it was before the precompiled expressions: every
+    # heading is visited and the last one wins, and all links of the table
+    # cells are scanned twice for author pages
+    title = None
+    for node in root.xpath('//tr/td/div/h1/strong'):
+        title = node.text_content().strip()
+    authors = []
+    for pattern in ('//tr/td/p/a', '//tr/td/a'):
+        for node in root.xpath(pattern):
+            url = node.get('href').strip()
+            if url.find('/autoreninfo.php') > -1:
+                authors.append(node.text_content().strip())
+    return (title, authors)
+
+
+def load_pages(directory):
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.html'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                raw = f.read().decode('iso-8859-1', 'replace')
+            pages.append(fromstring(raw))
+    return pages
+
+
+def pages_per_second(extract, pages, repeat):
+    start = time.time()
+    for i in range(repeat):
+        for root in pages:
+            extract(root)
+    return len(pages) * repeat / max(time.time() - start, 1e-9)
+
+
+def main(args):
+    if len(args) < 2:
+        print('Usage: bench_parse.py <directory with saved pages> [repeat]')
+        return 1
+    pages = load_pages(args[1])
+    repeat = int(args[2]) if len(args) > 2 else 200
+    if not pages:
+        print('No .html files found in', args[1])
+        return 1
+    before = pages_per_second(legacy_extract, pages, repeat)
+    after = pages_per_second(extract_details, pages, repeat)
+    print('%d pages, %d rounds' % (len(pages), repeat))
+    print('before: %10.1f pages/s' % before)
+    print('after:  %10.1f pages/s (%.2fx)' % (after, after / before))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+# Records pages from www.beam-ebooks.de into benchmarks/corpus, under the
+# names the stand-in server looks for. Arguments are beam ebooks ids or,
+# prefixed with "search:", title searches:
+#
+#     python benchmarks/record.py 12748 19938 "search:Projekt Saturn"
+
+import os
+import sys
+import time
+import urllib2
+
+from urllib import quote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin import CORPUS, search_slug
+
+BASE_URL = 'http://www.beam-ebooks.de'
+
+def record(arg):
+    if arg.startswith('search:'):
+        words = arg[len('search:'):]
+        url = '%s/suchergebnis.php?Type=Title&sw=%s&x=0&y=0' % (
+            BASE_URL, quote(words.encode('iso-8859-1')))
+        name = 'search_%s.html' % search_slug(words)
+    else:
+        url = '%s/ebook/%s' % (BASE_URL, arg)
+        name = 'ebook_%s.html' % arg
+    data = urllib2.urlopen(url, timeout=30).read()
+    with open(os.path.join(CORPUS, name), 'wb') as f:
+        f.write(data)
+    print('%s -> %s (%d bytes)' % (url, name, len(data)))
+
+
+def main(args):
+    for arg in args[1:]:
+        record(arg.decode(sys.getfilesystemencoding() or 'utf-8'))
+        # Be polite to the real site
+        time.sleep(1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+# Local stand-in for www.beam-ebooks.de, serving the recorded pages in
+# benchmarks/corpus with configurable latency, errors and timeouts. Run it
+# on its own with:
+#
+#     python benchmarks/standin.py --port 8080 --latency 150 --error-rate 0.05
+
+import hashlib
+import os
+import random
+import re
+import sys
+import time
+import zlib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+from threading import Thread
+from urlparse import urlparse, parse_qs
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+# Every cover is the same blank 1x1 image, the covers themselves are not
+# part of the corpus
+COVER = (b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!'
+         b'\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00'
+         b'\x00\x02\x02D\x01\x00;')
+
+def search_slug(words):
+    return re.sub(r'[^a-z0-9]+', '_', words.lower()).strip('_')
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body leave in one write, small separate writes on a
+    # kept-alive connection run into delayed acknowledgements
+    wbufsize = -1
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+        delay = server.latency + random.uniform(0, server.jitter)
+        roll = random.random()
+        if roll < server.timeout_rate:
+            # Hang for longer than any client timeout, then drop the connection
+            time.sleep(server.hang)
+            self.close_connection = 1
+            return
+        time.sleep(delay)
+        if roll < server.timeout_rate + server.error_rate:
+            self.send_page(500, b'<html><body>Internal Server Error</body></html>')
+            return
+
+        url = urlparse(self.path)
+        if re.match(r'^/+images/cover/\d+\.jpg$', url.path):
+            self.send_page(200, COVER, 'image/gif')
+            return
+        name = None
+        match = re.match(r'^/+ebook/(\d+)', url.path)
+        if match:
+            name = 'ebook_%s.html' % match.group(1)
+        elif url.path == '/suchergebnis.php':
+            words = parse_qs(url.query).get('sw', [''])[0].decode('iso-8859-1')
+            name = 'search_%s.html' % search_slug(words)
+
+        path = os.path.join(server.corpus, name) if name else None
+        if path is None or not os.path.exists(path):
+            # The real site answers unknown books with a 404 page and status 200
+            path = os.path.join(server.corpus, '404.html')
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not match:
+            self.send_page(200, data)
+            return
+        # Details pages carry validators, for the conditional requests of
+        # the library refresh
+        headers = {
+            'ETag': '"%s"' % hashlib.sha1(data).hexdigest(),
+            'Last-Modified': formatdate(os.path.getmtime(path), usegmt=True),
+        }
+        if self.headers.get('If-None-Match', None) == headers['ETag']:
+            self.send_response(304)
+            for (name, value) in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.send_page(200, data, headers=headers)
+
+    def send_page(self, code, data, content_type='text/html', headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+
+    '''
+    latency and jitter are in seconds, error_rate and timeout_rate are the
+    shares of requests answered with a 500 or not answered at all
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, port=0, corpus=CORPUS, latency=0.0, jitter=0.0,
+                 error_rate=0.0, timeout_rate=0.0, hang=60):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandinHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.requests = 0
+
+    def count_request(self):
+        self.requests += 1
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        t = Thread(target=self.serve_forever, name='BeamEbooksStandin')
+        t.daemon = True
+        t.start()
+        return self
+
+
+def option_parser():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--corpus', default=CORPUS)
+    parser.add_option('--latency', type='float', default=0,
+            help='Milliseconds to wait before answering')
+    parser.add_option('--jitter', type='float', default=0,
+            help='Random extra milliseconds to wait, up to this many')
+    parser.add_option('--error-rate', type='float', default=0,
+            help='Share of requests answered with status 500')
+    parser.add_option('--timeout-rate', type='float', default=0,
+            help='Share of requests never answered')
+    return parser
+
+
+def main(args):
+    (opts, args) = option_parser().parse_args(args[1:])
+    server = StandinServer(opts.port, opts.corpus, opts.latency / 1000.0,
+            opts.jitter / 1000.0, opts.error_rate, opts.timeout_rate)
+    print('Serving %s on %s' % (opts.corpus, server.base_url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import json
+import time
+
+from collections import deque
+from Queue import Queue, Empty
+from threading import Event, Lock, Semaphore
+
+from calibre_plugins.beam_ebooks_metadata.eventloop import fetch_details, fetch_search
+from calibre_plugins.beam_ebooks_metadata.pool import get_pool, ABORT_CHECK_INTERVAL
+from calibre_plugins.beam_ebooks_metadata.worker import Worker
+
+# Books taken from the input at a time, this bounds the memory of a bulk
+# run however many books it is given
+WINDOW = 500
+
+# Searches and details downloads in the worker pool at a time. The pool is
+# shared with identify, whose jobs only queue behind this many bulk jobs.
+POOL_WINDOW = 16
+
+class BulkIdentify(object):
+
+    '''
+    Identifies many books in one go, for refreshing the metadata of a whole
+    library. Books sharing a beam ebooks id, or a search query and authors,
+    are looked up only once, and the details page of every search hit is queued as soon as
+    its search is done, so searches and details downloads overlap in the
+    shared worker pool.
+
+    Books are taken WINDOW at a time, and the results of each book are
+    handed out as soon as its pages are parsed. Pages no other book is
+    waiting for are dropped right away. Duplicates in different windows are
+    found in the page caches instead.
+
+    At most POOL_WINDOW searches and details downloads are handed to the
+    worker pool at a time, details downloads first, so lookups started
+    during a bulk run are not stuck behind all of it.
+    '''
+
+    def __init__(self, plugin, log, abort=None, timeout=30, progress_interval=5,
+                 window=WINDOW, pool_window=POOL_WINDOW):
+        self.plugin = plugin
+        self.log = log
+        self.abort = abort if abort is not None else Event()
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        self.window = window
+        self.lock = Lock()
+        self.slots = Semaphore(pool_window)
+        self.searches = deque()
+        self.downloads = deque()
+        self.jobs_lock = Lock()
+
+    def run(self, books):
+        '''
+        books is a sequence of (title, authors, identifiers) tuples. Returns a
+        list with the Metadata objects found for each book, in the same order.
+        Books that resolved to the same page share the same Metadata objects.
+        '''
+        books = list(books)
+        results = [[] for b in books]
+        for (i, found) in self.stream(books):
+            results[i] = found
+        return results
+
+    def stream(self, books):
+        '''
+        Generator of (index, Metadata list) pairs for the (title, authors,
+        identifiers) tuples of books, in the order the books are done. books
+        can be any iterable, it is read as the run goes on.
+        '''
+        self.start = self.last_report = time.time()
+        self.books_read = 0
+        self.books_done = 0
+        batch = []
+        for book in books:
+            batch.append(book)
+            if len(batch) == self.window:
+                for result in self._stream_window(batch):
+                    yield result
+                batch = []
+            if self.abort.is_set():
+                return
+        if batch:
+            for result in self._stream_window(batch):
+                yield result
+        self._report_progress()
+        self.plugin._log_stats(self.log)
+
+    def _stream_window(self, books):
+        offset = self.books_read
+        self.books_read += len(books)
+        self.books = books
+        self.pending = [0] * len(books)
+        self.book_urls = [[] for b in books]
+        self.url_books = {}
+        self.url_queues = {}
+        self.url_results = {}
+        self.finished = Queue()
+
+        lookups = {}
+        for i, (title, authors, identifiers) in enumerate(books):
+            identifiers = identifiers or {}
+            beam_ebooks_id = identifiers.get('beam-ebooks', None)
+            if beam_ebooks_id:
+                key = ('beam-ebooks', beam_ebooks_id)
+            else:
+                try:
+                    query = self.plugin._create_query(self.log, title=title,
+                            authors=authors, identifiers=identifiers)
+                except:
+                    # One odd book must not end the run for the whole library
+                    self.log.exception('    Failed to construct query for: %r' % title)
+                    query = None
+                if query is None:
+                    self.log.error('    Insufficient metadata to construct query for: %r' % title)
+                    self.pending[i] = 1
+                    self._book_done(i)
+                    continue
+                # The hits are scored against the authors as well
+                key = ('query', query, tuple(authors or ()))
+            lookups.setdefault(key, []).append(i)
+
+        self.log.info('Bulk identify: %d books, %d distinct lookups' % (
+            len(books), len(lookups)))
+
+        # A book is done once its lookup and the details pages found by it
+        # are, lookups add their details pages before they finish themselves
+        for key, indices in lookups.iteritems():
+            for i in indices:
+                self.pending[i] += 1
+            if key[0] == 'beam-ebooks':
+                url = '%s/ebook/%s' % (self.plugin.BASE_URL, key[1])
+                self._lookup_done([url], indices)
+            else:
+                title, authors = books[indices[0]][:2]
+                self._queue(self.searches, self._start_search, key[1], title, authors, indices)
+        del lookups
+
+        for n in range(len(books)):
+            while True:
+                if self.abort.is_set():
+                    return
+                try:
+                    i = self.finished.get(True, ABORT_CHECK_INTERVAL)
+                    break
+                except Empty:
+                    pass
+                if time.time() - self.last_report >= self.progress_interval:
+                    self._report_progress()
+            yield (offset + i, self._release(i))
+
+    def _release(self, i):
+        # Returns the results of book i, and drops the pages no other book
+        # of the window is waiting for
+        found = []
+        with self.lock:
+            for url in self.book_urls[i]:
+                found.extend(self.url_results[url])
+                waiting = self.url_books[url]
+                waiting.remove(i)
+                if not waiting:
+                    del self.url_books[url]
+                    del self.url_queues[url]
+                    del self.url_results[url]
+            self.book_urls[i] = None
+            self.books[i] = None
+            self.books_done += 1
+        return found
+
+    def _queue(self, jobs, start, *args):
+        # Jobs wait here until there is a slot for them, and give it back
+        # with _job_done. This never blocks, the pool threads queue the
+        # details downloads of the searches they finish.
+        with self.jobs_lock:
+            jobs.append((start, args))
+        self._feed()
+
+    def _feed(self):
+        while not self.abort.is_set():
+            with self.jobs_lock:
+                jobs = self.downloads or self.searches
+                if not jobs or not self.slots.acquire(False):
+                    return
+                (start, args) = jobs.popleft()
+            start(*args)
+
+    def _job_done(self):
+        self.slots.release()
+        self._feed()
+
+    def _start_search(self, query, title, authors, indices):
+        if self.plugin.prefs['use_event_loop']:
+            fetch_search(self.plugin, self.log, query, title, authors,
+                    self.abort, self.timeout,
+                    lambda matches, err: self._search_done(matches, indices))
+        else:
+            get_pool(self.plugin).submit(self._search, query, title, authors, indices)
+
+    def _search(self, query, title, authors, indices):
+        matches = []
+        try:
+            self.plugin._search(self.log, query, title, authors, self.abort,
+                    self.timeout, matches)
+        finally:
+            self._search_done(matches, indices)
+
+    def _search_done(self, matches, indices):
+        try:
+            self._lookup_done(matches, indices)
+        finally:
+            self._job_done()
+
+    def _lookup_done(self, matches, indices):
+        with self.lock:
+            for relevance, url in enumerate(matches):
+                if url.find('/ebook/') == -1:
+                    continue
+                self.url_books.setdefault(url, []).extend(indices)
+                for i in indices:
+                    self.book_urls[i].append(url)
+                if url not in self.url_results:
+                    for i in indices:
+                        self.pending[i] += 1
+                if url in self.url_queues:
+                    # Some other lookup already found this page
+                    continue
+                self.url_queues[url] = Queue()
+                worker = Worker(url, self.url_queues[url], self.plugin.browser,
+                        self.log, relevance, self.plugin, abort=self.abort)
+                self._queue(self.downloads, self._start_details, worker)
+            for i in indices:
+                self._book_done(i)
+
+    def _start_details(self, worker):
+        if self.plugin.prefs['use_event_loop']:
+            fetch_details(self.plugin, worker, self._details_done)
+        else:
+            get_pool(self.plugin).submit(self._details, worker)
+
+    def _details(self, worker):
+        try:
+            worker.run()
+        finally:
+            self._details_done(worker)
+
+    def _details_done(self, worker):
+        with self.lock:
+            queue = self.url_queues[worker.url]
+            found = []
+            while True:
+                try:
+                    found.append(queue.get_nowait())
+                except Empty:
+                    break
+            self.url_results[worker.url] = found
+            for i in self.url_books[worker.url]:
+                self._book_done(i)
+        self._job_done()
+
+    def _book_done(self, i):
+        self.pending[i] -= 1
+        if self.pending[i] == 0:
+            self.finished.put(i)
+
+    def _report_progress(self):
+        self.last_report = time.time()
+        elapsed = max(self.last_report - self.start, 0.001)
+        self.log.info('Bulk identify: %d of %d books done, %.1f books/s' % (
+            self.books_done, self.books_read, self.books_done / elapsed))
+
+
+def bulk_identify(plugin, log, books, abort=None, timeout=30):
+    '''
+    Convenience wrapper around :class:`BulkIdentify`
+    '''
+    return BulkIdentify(plugin, log, abort=abort, timeout=timeout).run(books)
+
+
+def metadata_to_dict(mi):
+    '''
+    The fields this plugin fills in, as a dict that can be dumped to JSON
+    '''
+    return {
+        'title': mi.title,
+        'authors': mi.authors,
+        'series': mi.series,
+        'series_index': mi.series_index,
+        'identifiers': mi.get_identifiers(),
+        'has_cover': bool(mi.has_cover),
+    }
+
+
+def write_ndjson(results, f):
+    '''
+    Writes the (index, Metadata list) pairs of :meth:`BulkIdentify.stream`
+    to the file f as they come, one JSON object per book and line. Returns
+    the number of books written.
+    '''
+    n = 0
+    for (i, found) in results:
+        line = json.dumps({'index': i, 'results': [metadata_to_dict(mi) for mi in found]})
+        f.write(line.encode('utf-8') + b'\n')
+        n += 1
+    return n
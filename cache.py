@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import json
+import os
+import sqlite3
+import time
+
+from threading import Lock
+
+DAY = 24 * 60 * 60
+
+# Hits only move an entry up the LRU order once this much time has passed
+# since it was last marked as used, and the new access times are written
+# with the next put rather than committed on the read path
+ACCESS_INTERVAL = 60 * 60
+ACCESS_BATCH = 100
+
+class PageCache(object):
+
+    '''
+    Persistent, size-bounded store of downloaded pages, backed by one table
+    in an SQLite database. Entries expire after ``ttl`` seconds, and the least
+    recently used entries are evicted once more than ``max_entries`` are
+    stored.
+    '''
+
+    def __init__(self, path, table, max_entries=5000, ttl=30 * DAY):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.touched = {}
+
+        (self.conn, self.lock) = _connect(path)
+        with self.lock:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS %s ('
+                'key TEXT PRIMARY KEY, value TEXT, '
+                'stored REAL, accessed REAL)' % self.table)
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS %s_accessed ON %s (accessed)'
+                % (self.table, self.table))
+            self.conn.commit()
+            self.count = self.conn.execute(
+                'SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def configure(self, max_entries, ttl):
+        # Going below the stored entries evicts them with the next put
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, stored, accessed FROM %s WHERE key=?' % self.table,
+                (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, stored, accessed = row
+            if now - stored > self.ttl:
+                # Left for the next put to overwrite or evict
+                self.misses += 1
+                return None
+            if now - accessed > ACCESS_INTERVAL:
+                self.touched[key] = now
+                if len(self.touched) >= ACCESS_BATCH:
+                    self._write_touched()
+                    self.conn.commit()
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                'UPDATE %s SET value=?, stored=?, accessed=? WHERE key=?'
+                % self.table, (value, now, now, key))
+            if cursor.rowcount == 0:
+                self.conn.execute(
+                    'INSERT INTO %s (key, value, stored, accessed) VALUES (?, ?, ?, ?)'
+                    % self.table, (key, value, now, now))
+                self.count += 1
+            self.touched.pop(key, None)
+            self._write_touched()
+            if self.count > self.max_entries:
+                self._evict(self.count - self.max_entries)
+            self.conn.commit()
+
+    def _write_touched(self):
+        if self.touched:
+            self.conn.executemany(
+                'UPDATE %s SET accessed=? WHERE key=?' % self.table,
+                [(accessed, key) for (key, accessed) in self.touched.items()])
+            self.touched = {}
+
+    def _evict(self, n):
+        # Expired entries go first, then the least recently used ones
+        cursor = self.conn.execute(
+            'DELETE FROM %s WHERE stored < ?' % self.table,
+            (time.time() - self.ttl,))
+        evicted = max(cursor.rowcount, 0)
+        if evicted < n:
+            cursor = self.conn.execute(
+                'DELETE FROM %s WHERE key IN '
+                '(SELECT key FROM %s ORDER BY accessed LIMIT ?)'
+                % (self.table, self.table), (n - evicted,))
+            evicted += max(cursor.rowcount, 0)
+        self.count -= evicted
+        self.evictions += evicted
+
+    def stats(self):
+        return '%s cache: %d hits, %d misses, %d evictions, %d entries' % (
+            self.table, self.hits, self.misses, self.evictions, self.count)
+
+
+_connections = {}
+_connections_lock = Lock()
+
+def _connect(path):
+    # All caches in the same file share one connection and the lock that
+    # serializes statements on it
+    with _connections_lock:
+        entry = _connections.get(path, None)
+        if entry is None:
+            if path != ':memory:':
+                directory = os.path.dirname(path)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory)
+            conn = sqlite3.connect(path, check_same_thread=False)
+            if path != ':memory:':
+                # Commits then only append to the write-ahead log instead of
+                # syncing the database file each time
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            entry = (conn, Lock())
+            _connections[path] = entry
+        return entry
+
+
+def default_cache_path():
+    # The benchmarks point this to a scratch file
+    path = os.environ.get('BEAM_EBOOKS_CACHE', None)
+    if path:
+        return path
+    from calibre.utils.config import config_dir
+    return os.path.join(config_dir, 'plugins', 'beam_ebooks_metadata_cache.sqlite')
+
+
+_details_cache = None
+_details_cache_lock = Lock()
+
+def get_details_cache(plugin):
+    '''
+    The process-wide cache of /ebook/<id> pages, keyed by beam ebooks id.
+    Follows changes of the cache options.
+    '''
+    global _details_cache
+    max_entries = int(plugin.prefs['cache_max_entries'])
+    ttl = int(plugin.prefs['cache_ttl_days']) * DAY
+    with _details_cache_lock:
+        if _details_cache is None:
+            _details_cache = PageCache(default_cache_path(), 'details',
+                    max_entries=max_entries, ttl=ttl)
+        else:
+            _details_cache.configure(max_entries, ttl)
+        return _details_cache
+
+
+class SearchCache(object):
+
+    '''
+    Maps a search query to what the site answered: the details page it went
+    straight to, if any, and the (url, title, author) hits of the result
+    page. The hits are kept unscored, since books by the same author share
+    the author searches. Queries that found nothing are remembered too, but
+    for a shorter time, since the book may show up in the shop later on.
+    '''
+
+    def __init__(self, path, max_entries=5000, ttl=7 * DAY, miss_ttl=DAY // 2):
+        self.found = PageCache(path, 'search_hits', max_entries=max_entries, ttl=ttl)
+        self.missing = PageCache(path, 'search_hits_missing', max_entries=max_entries, ttl=miss_ttl)
+
+    def configure(self, max_entries, ttl, miss_ttl):
+        self.found.configure(max_entries, ttl)
+        self.missing.configure(max_entries, miss_ttl)
+
+    def _key(self, query):
+        return query.lower()
+
+    def get(self, query):
+        '''
+        Returns (location, hits), with location None unless the site went
+        straight to a details page, (None, []) for a cached miss, or None if
+        the query has not been seen recently
+        '''
+        key = self._key(query)
+        value = self.found.get(key)
+        if value is not None:
+            value = json.loads(value)
+            return (value['location'], [tuple(hit) for hit in value['hits']])
+        if self.missing.get(key) is not None:
+            return (None, [])
+        return None
+
+    def put(self, query, location, hits):
+        key = self._key(query)
+        if location or hits:
+            self.found.put(key, json.dumps({'location': location, 'hits': hits}))
+        else:
+            self.missing.put(key, '')
+
+    def stats(self):
+        return '%s; %s' % (self.found.stats(), self.missing.stats())
+
+
+_search_cache = None
+_search_cache_lock = Lock()
+
+def get_search_cache(plugin):
+    '''
+    The process-wide cache of search results, keyed by query URL. Follows
+    changes of the cache options.
+    '''
+    global _search_cache
+    max_entries = int(plugin.prefs['cache_max_entries'])
+    ttl = int(plugin.prefs['search_cache_ttl_days']) * DAY
+    miss_ttl = int(plugin.prefs['search_miss_ttl_hours']) * 60 * 60
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache(default_cache_path(), max_entries=max_entries,
+                    ttl=ttl, miss_ttl=miss_ttl)
+        else:
+            _search_cache.configure(max_entries, ttl, miss_ttl)
+        return _search_cache
+
+
+_missing_cache = None
+_missing_cache_lock = Lock()
+
+def get_missing_cache(plugin):
+    '''
+    The process-wide record of beam ebooks ids the site answered with its
+    404 page, so that they are not asked for again and again. Follows
+    changes of the cache options.
+    '''
+    global _missing_cache
+    max_entries = int(plugin.prefs['cache_max_entries'])
+    ttl = int(plugin.prefs['missing_ttl_hours']) * 60 * 60
+    with _missing_cache_lock:
+        if _missing_cache is None:
+            _missing_cache = PageCache(default_cache_path(), 'missing',
+                    max_entries=max_entries, ttl=ttl)
+        else:
+            _missing_cache.configure(max_entries, ttl)
+        return _missing_cache
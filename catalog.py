@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+import sys
+import time
+
+from threading import Lock
+
+from calibre_plugins.beam_ebooks_metadata.cache import _connect, default_cache_path
+from calibre_plugins.beam_ebooks_metadata.scoring import normalize, series_issue, strip_series
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Added books are written to disk in batches of this many, or once this
+# many seconds have passed since the last write
+COMMIT_INTERVAL = 50
+COMMIT_SECONDS = 30
+
+class Catalog(object):
+
+    '''
+    Local index of Beam Ebooks books with full text search over title and
+    authors, so that title lookups can be answered without going to the
+    site. It is filled from parsed details pages, see :func:`build_catalog`.
+    '''
+
+    def __init__(self, path):
+        (self.conn, self.lock) = _connect(path)
+        with self.lock:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS catalog ('
+                'rowid INTEGER PRIMARY KEY, id TEXT UNIQUE, title TEXT, '
+                'authors TEXT, series TEXT, series_index REAL)')
+            self.conn.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts '
+                'USING fts4(title, authors)')
+            self.conn.commit()
+        self.unsaved = 0
+        self.saved = time.time()
+
+    def add(self, beam_ebooks_id, title, authors, series=None, series_index=None):
+        authors = ' & '.join(authors or [])
+        with self.lock:
+            row = self.conn.execute('SELECT rowid FROM catalog WHERE id=?',
+                    (beam_ebooks_id,)).fetchone()
+            if row is None:
+                rowid = self.conn.execute(
+                    'INSERT INTO catalog (id, title, authors, series, series_index) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (beam_ebooks_id, title, authors, series, series_index)).lastrowid
+            else:
+                rowid = row[0]
+                self.conn.execute(
+                    'UPDATE catalog SET title=?, authors=?, series=?, series_index=? '
+                    'WHERE rowid=?', (title, authors, series, series_index, rowid))
+                self.conn.execute('DELETE FROM catalog_fts WHERE rowid=?', (rowid,))
+            self.conn.execute(
+                'INSERT INTO catalog_fts (rowid, title, authors) VALUES (?, ?, ?)',
+                (rowid, title, authors))
+            self.unsaved += 1
+            if self.unsaved >= COMMIT_INTERVAL or \
+                    time.time() - self.saved > COMMIT_SECONDS:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.conn.commit()
+        self.unsaved = 0
+        self.saved = time.time()
+
+    def add_metadata(self, mi):
+        beam_ebooks_id = mi.identifiers.get('beam-ebooks', None)
+        if beam_ebooks_id and mi.title:
+            self.add(beam_ebooks_id, mi.title, mi.authors, mi.series, mi.series_index)
+
+    def lookup(self, title, authors=None, limit=3):
+        '''
+        Returns the beam ebooks ids of the books whose title is title, with
+        or without the series decorations like the PRnnnn prefix, best
+        matches first. Books that share an author rank before the others.
+        Titles that merely contain the words of title are left to the
+        search, which scores its hits.
+        '''
+        words = [w.lower() for w in WORD.findall(strip_series(title))]
+        if not words:
+            return []
+        query = ' '.join('title:%s' % w for w in words)
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT catalog.id, catalog.title, catalog.authors FROM catalog_fts '
+                'JOIN catalog ON catalog.rowid = catalog_fts.rowid '
+                'WHERE catalog_fts MATCH ?', (query,)).fetchall()
+
+        # Catalog titles carry the PRnnnn prefix, search titles may not,
+        # but where both have an issue number it has to be the same
+        wanted = set([normalize(title), normalize(strip_series(title))])
+        issue = series_issue(title)
+        rows = [row for row in rows if
+                (normalize(row[1]) in wanted or normalize(strip_series(row[1])) in wanted)
+                and (issue is None or series_issue(row[1]) in (None, issue))]
+        wanted_authors = set(a.lower() for a in (authors or []))
+        def rank(row):
+            (beam_ebooks_id, found_title, found_authors) = row
+            shared = bool(wanted_authors.intersection(
+                a.lower() for a in found_authors.split(' & ')))
+            return (not shared, len(found_title))
+        rows.sort(key=rank)
+        return [row[0] for row in rows[:limit]]
+
+    def find_issue(self, series, series_index):
+        '''
+        Returns the beam ebooks ids of the books with the given index in the
+        series, whatever its cycle
+        '''
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id FROM catalog WHERE (series = ? OR series LIKE ?) '
+                'AND series_index = ?',
+                (series, series + ',%', float(series_index))).fetchall()
+        return [row[0] for row in rows]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM catalog').fetchone()[0]
+
+
+_catalog = None
+_catalog_lock = Lock()
+_catalog_failed = False
+
+def get_catalog():
+    '''
+    The process-wide local catalog, stored next to the page caches
+    '''
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog(default_cache_path())
+        return _catalog
+
+
+def use_catalog(plugin):
+    '''
+    False if the catalog is turned off, or has failed in this session
+    '''
+    return plugin.prefs['use_catalog'] and not _catalog_failed
+
+
+def disable_catalog(log):
+    '''
+    Logs the error being handled and stops using the catalog until calibre
+    is restarted, lookups go to the site instead
+    '''
+    global _catalog_failed
+    _catalog_failed = True
+    log.exception('The local catalog failed, it is not used until calibre is restarted')
+
+
+def build_catalog(plugin, log, beam_ebooks_ids, abort=None):
+    '''
+    Adds the books with the given beam ebooks ids to the local catalog.
+    Pages still in the details cache are not downloaded again.
+    '''
+    books = [(None, None, {'beam-ebooks': beam_ebooks_id})
+             for beam_ebooks_id in beam_ebooks_ids]
+    catalog = get_catalog()
+    for found in plugin.bulk_identify(log, books, abort=abort):
+        for mi in found:
+            catalog.add_metadata(mi)
+    catalog.save()
+    log.info('Catalog holds %d books' % len(catalog))
+
+
+def parse_ids(args):
+    ids = []
+    for arg in args:
+        if '-' in arg:
+            (first, last) = arg.split('-', 1)
+            ids.extend(unicode(i) for i in range(int(first), int(last) + 1))
+        else:
+            ids.append(arg)
+    return ids
+
+
+if __name__ == '__main__':
+    # To fill the catalog with a range of books, use:
+    # calibre-debug -e catalog.py -- 12000-20000 23456
+    from calibre.customize.ui import metadata_plugins
+    from calibre.utils.logging import default_log
+    plugin = [p for p in metadata_plugins(['identify']) if p.name == 'Beam Ebooks'][0]
+    build_catalog(plugin, default_log, parse_ids(sys.argv[1:]))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import os
+import tempfile
+import time
+
+from threading import Event, Lock
+
+from calibre_plugins.beam_ebooks_metadata.cache import _connect, default_cache_path
+from calibre_plugins.beam_ebooks_metadata.pool import ABORT_CHECK_INTERVAL, get_rate_limiter
+from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+from calibre_plugins.beam_ebooks_metadata.transport import get_transport, READ_SIZE
+
+MB = 1024 * 1024
+
+class CoverCache(object):
+
+    '''
+    Cover images on disk, each stored under the SHA-1 of its content, so a
+    cover shared by several books is kept only once. A table next to the
+    page caches maps cover urls to files and remembers when they were last
+    used; the least recently used covers are removed once the files add up
+    to more than max_bytes. Concurrent fetches of the same url share one
+    download.
+    '''
+
+    def __init__(self, directory, db_path, max_bytes=100 * MB):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.downloads = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.in_flight = {}
+        self.in_flight_lock = Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        (self.conn, self.lock) = _connect(db_path)
+        with self.lock:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS covers ('
+                'url TEXT PRIMARY KEY, digest TEXT, size INTEGER, accessed REAL)')
+            self.conn.commit()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.img')
+
+    def get(self, url):
+        '''
+        The cached cover of url, or None
+        '''
+        data = self._read(url)
+        if data is not None:
+            self.hits += 1
+        return data
+
+    def _read(self, url):
+        with self.lock:
+            row = self.conn.execute('SELECT digest FROM covers WHERE url=?',
+                    (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self._path(row[0]), 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                # Removed behind our back
+                self.conn.execute('DELETE FROM covers WHERE url=?', (url,))
+                self.conn.commit()
+                return None
+            self.conn.execute('UPDATE covers SET accessed=? WHERE url=?',
+                    (time.time(), url))
+            self.conn.commit()
+            return data
+
+    def fetch(self, plugin, log, url, abort, timeout=30):
+        '''
+        Returns the cover image at url, from the cache or downloaded into it.
+        Returns None if it could not be downloaded or abort was set.
+        '''
+        data = self.get(url)
+        if data is not None:
+            return data
+
+        with self.in_flight_lock:
+            done = self.in_flight.get(url, None)
+            leader = done is None
+            if leader:
+                done = self.in_flight[url] = Event()
+        if not leader:
+            # Someone else is downloading this cover already
+            self.coalesced += 1
+            while not done.wait(ABORT_CHECK_INTERVAL):
+                if abort.is_set():
+                    return None
+            return self._read(url)
+
+        try:
+            with get_tracer(plugin).phase('cover_fetch'):
+                if self._download(plugin, log, url, abort, timeout):
+                    return self._read(url)
+            return None
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[url]
+            done.set()
+
+    def _download(self, plugin, log, url, abort, timeout):
+        # The image is streamed into a scratch file while it is hashed, and
+        # then renamed to its digest
+        if not get_rate_limiter(plugin).acquire(abort):
+            return False
+        try:
+            response = get_transport(plugin).open(url, timeout=timeout, abort=abort)
+        except:
+            log.exception('Failed to download cover from: %r' % url)
+            return False
+        if response is None:
+            return False
+        if not response.info().gettype().startswith('image/'):
+            log.error('Not a cover image: %r' % url)
+            response.close()
+            return False
+
+        (fd, scratch) = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        digest = hashlib.sha1()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    if abort.is_set():
+                        response.close()
+                        return False
+                    chunk = response.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if size == 0:
+                return False
+            digest = digest.hexdigest()
+            with self.lock:
+                path = self._path(digest)
+                if os.path.exists(path):
+                    os.remove(scratch)
+                else:
+                    os.rename(scratch, path)
+                self.conn.execute('DELETE FROM covers WHERE url=?', (url,))
+                self.conn.execute(
+                    'INSERT INTO covers (url, digest, size, accessed) VALUES (?, ?, ?, ?)',
+                    (url, digest, size, time.time()))
+                self._evict()
+                self.conn.commit()
+            self.downloads += 1
+            return True
+        except:
+            log.exception('Failed to download cover from: %r' % url)
+            return False
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+    def _evict(self):
+        stored = self.conn.execute(
+            'SELECT digest, MAX(size), MAX(accessed) FROM covers GROUP BY digest '
+            'ORDER BY MAX(accessed)').fetchall()
+        total = sum(size for (digest, size, accessed) in stored)
+        # The newest cover stays even if it is larger than the limit
+        for (digest, size, accessed) in stored[:-1]:
+            if total <= self.max_bytes:
+                break
+            self.conn.execute('DELETE FROM covers WHERE digest=?', (digest,))
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        return 'cover cache: %d hits, %d downloads, %d coalesced, %d evictions' % (
+            self.hits, self.downloads, self.coalesced, self.evictions)
+
+
+_cover_cache = None
+_cover_cache_lock = Lock()
+
+def get_cover_cache(plugin):
+    '''
+    The process-wide cover cache, in a directory next to the page caches.
+    Follows changes of the cover_cache_mb option.
+    '''
+    global _cover_cache
+    max_bytes = int(plugin.prefs['cover_cache_mb']) * MB
+    with _cover_cache_lock:
+        if _cover_cache is None:
+            path = default_cache_path()
+            directory = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                     'beam_ebooks_metadata_covers')
+            _cover_cache = CoverCache(directory, path, max_bytes=max_bytes)
+        else:
+            _cover_cache.max_bytes = max_bytes
+        return _cover_cache
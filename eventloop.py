@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+# A single thread that keeps many downloads in flight on non-blocking
+# sockets, for when the worker threads would mostly sit waiting on the
+# site. Python 2 has no asyncio, the loop is built on asyncore. Parsing and
+# the caches stay on the shared worker pool, the loop thread only moves
+# bytes.
+
+import asyncore
+import socket
+import sys
+import time
+import zlib
+
+from collections import deque
+from httplib import HTTPMessage
+from StringIO import StringIO
+from threading import Event, Lock, Thread
+from urllib import getproxies
+from urllib2 import HTTPError
+from urlparse import urljoin
+
+from calibre_plugins.beam_ebooks_metadata.health import get_site_health, CircuitOpen
+from calibre_plugins.beam_ebooks_metadata.pool import get_pool, get_rate_limiter, Completion
+from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+from calibre_plugins.beam_ebooks_metadata.transport import (get_transport, route,
+        USER_AGENT, MAX_REDIRECTS, READ_SIZE, REDIRECT_CODES)
+from calibre_plugins.beam_ebooks_metadata.worker import Worker, cut_details, read_response
+
+# How long select() waits while downloads are in flight, which is also how
+# late a newly queued download or an expired timeout is noticed
+LOOP_INTERVAL = 0.01
+
+class Aborted(Exception):
+    pass
+
+
+class Page(object):
+
+    '''
+    The outcome of one download: the final url, status and body, or the
+    exception that ended it
+    '''
+
+    def __init__(self, url, code=None, data=None, error=None, elapsed=0.0):
+        self.url = url
+        self.code = code
+        self.data = data
+        self.error = error
+        self.elapsed = elapsed
+
+
+class HTTPFetch(asyncore.dispatcher):
+
+    '''
+    One GET request on a non-blocking socket. The response is read until
+    the site closes the connection, so it asks for HTTP/1.0.
+    '''
+
+    def __init__(self, loop, url, timeout, callback, abort, redirects=0, started=None):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.url = url
+        self.callback = callback
+        self.abort = abort
+        self.redirects = redirects
+        self.started = started if started is not None else time.time()
+        self.sent = time.time()
+        self.deadline = self.sent + timeout
+        self.timeout = timeout
+        self.received = []
+        self.done = False
+        ((scheme, host, port), path, host_header) = route(url, loop.proxies)
+        self.outbuf = ('GET %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: %s\r\n'
+                       'Accept-Encoding: gzip\r\nConnection: close\r\n\r\n' % (
+                           path, host_header, loop.user_agent)).encode('ascii')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((loop.resolve(host), port))
+        except socket.error as e:
+            self.finish(error=e)
+
+    def writable(self):
+        return not self.connected or bool(self.outbuf)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(READ_SIZE)
+        if data:
+            self.received.append(data)
+
+    def handle_close(self):
+        self.finish()
+
+    def handle_error(self):
+        self.finish(error=sys.exc_info()[1])
+
+    def check(self, now):
+        if self.abort is not None and self.abort.is_set():
+            self.finish(error=Aborted())
+        elif now > self.deadline:
+            self.finish(error=socket.timeout('timed out'))
+
+    def finish(self, error=None):
+        if self.done:
+            return
+        self.done = True
+        self.close()
+        page = None
+        if error is None:
+            try:
+                page = self.parse_response(b''.join(self.received))
+            except Exception as e:
+                error = e
+        if page is None:
+            page = Page(self.url, error=error)
+        if isinstance(error, Aborted):
+            pass
+        elif error is not None or page.code >= 500:
+            self.loop.health.failed()
+        else:
+            self.loop.health.succeeded(time.time() - self.sent)
+        if page.code in REDIRECT_CODES and page.data is None:
+            # parse_response kept the body of redirects without a location
+            if page.url == self.url:
+                page.error = HTTPError(self.url, page.code, 'Redirect to itself', None, None)
+            elif self.redirects < MAX_REDIRECTS:
+                remaining = max(self.deadline - time.time(), 0)
+                HTTPFetch(self.loop, page.url, remaining, self.callback, self.abort,
+                          self.redirects + 1, self.started)
+                return
+            else:
+                page.error = HTTPError(self.url, page.code, 'Too many redirects', None, None)
+        page.elapsed = time.time() - self.started
+        self.loop.finished(page, self.callback)
+
+    def parse_response(self, response):
+        (head, sep, body) = response.partition(b'\r\n\r\n')
+        if not sep:
+            raise socket.error('Connection closed before the response was complete')
+        (status, sep, headers) = head.partition(b'\r\n')
+        (version, code, reason) = (status.split(None, 2) + [b''] * 3)[:3]
+        code = int(code)
+        headers = HTTPMessage(StringIO(headers + b'\r\n'))
+        if code in REDIRECT_CODES and headers.getheader('location'):
+            return Page(urljoin(self.url, headers.getheader('location')), code)
+        if code >= 400:
+            return Page(self.url, code, error=HTTPError(self.url, code, reason, headers, None))
+        if (headers.getheader('content-encoding') or '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return Page(self.url, code, body)
+
+
+class EventLoop(object):
+
+    '''
+    Runs the downloads queued with :meth:`fetch` on one thread. At most
+    max_in_flight of them are open at the same time, and each one waits for
+    a token of the shared rate limiter before it starts, without blocking
+    the others.
+    '''
+
+    def __init__(self, rate_limiter, max_in_flight=4, user_agent=USER_AGENT):
+        self.rate_limiter = rate_limiter
+        self.max_in_flight = max_in_flight
+        self.user_agent = user_agent
+        self.proxies = getproxies()
+        self.health = get_site_health()
+        self.map = {}
+        self.waiting = deque()
+        self.addresses = {}
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.started = 0
+        self.peak_in_flight = 0
+        self.thread = Thread(target=self._run, name='BeamEbooksEventLoop')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fetch(self, url, timeout, callback, abort=None):
+        '''
+        Queues a download of url. callback gets the :class:`Page` on the
+        loop thread, so it must hand any real work to the worker pool.
+        '''
+        with self.lock:
+            self.waiting.append((url, timeout, callback, abort))
+        self.wakeup.set()
+
+    def resolve(self, host):
+        # Name lookups block, but there is only the one host to look up
+        if host not in self.addresses:
+            self.addresses[host] = socket.gethostbyname(host)
+        return self.addresses[host]
+
+    def finished(self, page, callback):
+        try:
+            callback(page)
+        except:
+            import traceback
+            traceback.print_exc()
+
+    def _run(self):
+        while True:
+            self._start_waiting()
+            if self.map:
+                asyncore.loop(timeout=LOOP_INTERVAL, map=self.map, count=1)
+                now = time.time()
+                for fetch in list(self.map.values()):
+                    fetch.check(now)
+            else:
+                self.wakeup.wait(LOOP_INTERVAL if self.waiting else None)
+                self.wakeup.clear()
+
+    def _start_waiting(self):
+        while self.waiting and len(self.map) < self.max_in_flight:
+            with self.lock:
+                (url, timeout, callback, abort) = self.waiting[0]
+            if abort is not None and abort.is_set():
+                with self.lock:
+                    self.waiting.popleft()
+                self.finished(Page(url, error=Aborted()), callback)
+                continue
+            # The token comes first, an open circuit lets one trial request
+            # through and it must not be spent while waiting for a token
+            if not self.rate_limiter.try_acquire():
+                break
+            with self.lock:
+                self.waiting.popleft()
+            try:
+                self.health.check()
+            except CircuitOpen as e:
+                self.finished(Page(url, error=e), callback)
+                continue
+            self.started += 1
+            HTTPFetch(self, url, self.health.timeout(timeout), callback, abort)
+            self.peak_in_flight = max(self.peak_in_flight, len(self.map))
+
+    def stats(self):
+        return 'Event loop: %d downloads, at most %d in flight' % (
+            self.started, self.peak_in_flight)
+
+
+_loop = None
+_loop_lock = Lock()
+
+def get_event_loop(plugin):
+    '''
+    The process-wide event loop for downloads from Beam Ebooks. Follows
+    changes of the max_connections option.
+    '''
+    global _loop
+    max_in_flight = int(plugin.prefs['max_connections'])
+    with _loop_lock:
+        if _loop is None:
+            _loop = EventLoop(get_rate_limiter(plugin), max_in_flight)
+        else:
+            _loop.max_in_flight = max_in_flight
+        return _loop
+
+
+def fetch_page(plugin, url, timeout, callback, abort=None):
+    '''
+    Downloads url on the event loop. Only plain http is spoken there, other
+    urls are downloaded through the connection pool on a worker thread.
+    '''
+    if url.startswith('http://'):
+        get_event_loop(plugin).fetch(url, timeout, callback, abort)
+        return
+
+    def blocking_fetch():
+        start = time.time()
+        try:
+            if not get_rate_limiter(plugin).acquire(abort):
+                raise Aborted()
+            response = get_transport(plugin).open(url, timeout=timeout, abort=abort)
+            data = read_response(response, abort) if response is not None else None
+            if data is None:
+                raise Aborted()
+            page = Page(response.geturl(), response.getcode(), data)
+        except Exception as e:
+            page = Page(url, error=e)
+        page.elapsed = time.time() - start
+        callback(page)
+    get_pool(plugin).submit(blocking_fetch)
+
+
+def fetch_details(plugin, worker, done):
+    '''
+    Runs worker with its download on the event loop instead of a worker
+    thread. The cache and the parsing still run on the worker pool. done is
+    called when the worker has finished, whatever the outcome.
+    '''
+    tracer = get_tracer(plugin)
+
+    def finish():
+        if worker.completion is not None:
+            worker.completion.finished()
+        if done is not None:
+            done(worker)
+
+    def start():
+        try:
+            if worker.abort.is_set() or worker.url.find('/ebook/') == -1:
+                return finish()
+            raw = worker.cached_details()
+            if raw is not None:
+                worker.process_details(raw)
+                return finish()
+            if worker.known_missing():
+                return finish()
+        except:
+            worker.log.exception('get_details failed for url: %r' % worker.url)
+            return finish()
+        fetch_page(plugin, worker.url, worker.timeout, downloaded, worker.abort)
+
+    def downloaded(page):
+        get_pool(plugin).submit(process, page)
+
+    def process(page):
+        try:
+            tracer.record('details_fetch', page.elapsed)
+            if page.error is not None:
+                if not isinstance(page.error, Aborted):
+                    worker.download_failed(page.error)
+                return
+            # The whole page came in on the loop, only the metadata block
+            # is kept and parsed
+            raw = worker.decode_details(cut_details(page.data))
+            if raw is None:
+                return
+            worker.store_details(raw)
+            worker.process_details(raw)
+        except:
+            worker.log.exception('get_details failed for url: %r' % worker.url)
+        finally:
+            finish()
+
+    get_pool(plugin).submit(start)
+
+
+def fetch_search(plugin, log, query, title, authors, abort, timeout, done):
+    '''
+    Runs the search for query with its download on the event loop. done
+    gets the list of urls found and an error message or None.
+    '''
+    tracer = get_tracer(plugin)
+    matches = []
+
+    def start():
+        try:
+            if plugin._search_cached(log, query, title, authors, matches):
+                return done(matches, None)
+        except Exception as e:
+            log.exception("    Failed to make identify query: %r" % query)
+            return done(matches, unicode(e))
+        log.debug("    Querying: %s" % query)
+        tracer.count('search_request')
+        fetch_page(plugin, query, timeout, downloaded, abort)
+
+    def downloaded(page):
+        get_pool(plugin).submit(process, page)
+
+    def process(page):
+        err = None
+        try:
+            tracer.record('search_fetch', page.elapsed)
+            if isinstance(page.error, Aborted):
+                pass
+            elif page.error is not None:
+                log.error("    Failed to make identify query: %r (%s)" % (query, page.error))
+                err = unicode(page.error)
+            else:
+                err = plugin._search_downloaded(log, query, title, authors,
+                        page.url, page.data, timeout, matches)
+        except Exception as e:
+            log.exception("    Failed to make identify query: %r" % query)
+            err = unicode(e)
+        done(matches, err)
+
+    get_pool(plugin).submit(start)
+
+
+def identify(plugin, log, result_queue, abort, query, title, authors, beam_ebooks_id,
+             timeout):
+    '''
+    identify with every download on the event loop. The url of
+    beam_ebooks_id is looked up if it is set, query otherwise. The Metadata
+    found goes to result_queue. Returns an error message if the search
+    failed.
+    '''
+    completion = Completion(1)
+    errors = []
+
+    def found(matches, err):
+        if err is not None:
+            errors.append(err)
+        log.debug("    Matches are: %s" % matches)
+        if not abort.is_set():
+            completion.add(len(matches))
+            for i, url in enumerate(matches):
+                worker = Worker(url, result_queue, None, log, i, plugin,
+                                abort=abort, completion=completion,
+                                exact=bool(beam_ebooks_id) and i == 0)
+                fetch_details(plugin, worker, None)
+        completion.finished()
+
+    if beam_ebooks_id:
+        found(['%s/ebook/%s' % (plugin.BASE_URL, beam_ebooks_id)], None)
+    else:
+        fetch_search(plugin, log, query, title, authors, abort, timeout, found)
+    completion.wait(abort)
+    return errors[0] if errors else None
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+
+from collections import deque
+from threading import Lock
+
+# Consecutive failed requests that open the circuit breaker
+FAILURE_THRESHOLD = 5
+
+# Seconds the breaker stays open before one request may try again, doubled
+# after every failed try up to MAX_COOLDOWN
+COOLDOWN = 30
+MAX_COOLDOWN = 10 * 60
+
+# The timeout of a request is TIMEOUT_FACTOR times the 95th percentile of
+# the last LATENCY_WINDOW response times, but never shorter than
+# MIN_TIMEOUT and never longer than the timeout asked for. It is only
+# adapted once MIN_SAMPLES responses have been seen.
+LATENCY_WINDOW = 100
+MIN_SAMPLES = 20
+TIMEOUT_FACTOR = 3
+MIN_TIMEOUT = 5
+
+# Slow requests are hedged after the 95th percentile of the response times,
+# or after HEDGE_DELAY seconds while it is not known yet, but never before
+# MIN_HEDGE_DELAY, so that a site answering quickly does not get every
+# request twice
+HEDGE_DELAY = 2.0
+MIN_HEDGE_DELAY = 0.2
+
+class CircuitOpen(Exception):
+
+    '''
+    Raised instead of sending a request while Beam Ebooks is considered down
+    '''
+
+    def __init__(self, seconds):
+        Exception.__init__(self, 'Beam Ebooks is not answering, '
+                           'next try in %d seconds' % seconds)
+
+
+class SiteHealth(object):
+
+    '''
+    Circuit breaker and adaptive timeouts for all requests to the site.
+    Timeouts, connection errors and server errors count as failures; after
+    FAILURE_THRESHOLD of them in a row, requests fail at once with
+    :class:`CircuitOpen` until the cooldown has passed. Then a single
+    request is let through: if it succeeds the breaker closes again,
+    otherwise the cooldown doubles.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.failures = 0
+        self.opened = None
+        self.cooldown = COOLDOWN
+        self.rejected = 0
+        self.trips = 0
+
+    def check(self):
+        '''
+        Raises :class:`CircuitOpen` if no request should be sent now
+        '''
+        with self.lock:
+            if self.opened is None:
+                return
+            waited = time.time() - self.opened
+            if waited < self.cooldown:
+                self.rejected += 1
+                raise CircuitOpen(self.cooldown - waited)
+            # Let this one request through, the next one waits for another
+            # cooldown unless this one succeeds
+            self.opened = time.time()
+
+    def percentile(self, p):
+        '''
+        The p-th percentile of the recent response times in seconds, or None
+        while fewer than MIN_SAMPLES have been seen
+        '''
+        with self.lock:
+            if len(self.latencies) < MIN_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[int(p / 100 * (len(latencies) - 1))]
+
+    def hedge_delay(self):
+        '''
+        Seconds after which an unanswered request is worth sending again
+        '''
+        p95 = self.percentile(95)
+        if p95 is None:
+            return HEDGE_DELAY
+        return max(p95, MIN_HEDGE_DELAY)
+
+    def timeout(self, timeout):
+        p95 = self.percentile(95)
+        if p95 is None:
+            return timeout
+        return min(timeout, max(MIN_TIMEOUT, p95 * TIMEOUT_FACTOR))
+
+    def succeeded(self, elapsed):
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.failures = 0
+            if self.opened is not None:
+                self.opened = None
+                self.cooldown = COOLDOWN
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened is not None:
+                # The request let through after the cooldown failed as well
+                self.opened = time.time()
+                self.cooldown = min(self.cooldown * 2, MAX_COOLDOWN)
+            elif self.failures >= FAILURE_THRESHOLD:
+                self.opened = time.time()
+                self.trips += 1
+
+    def stats(self):
+        with self.lock:
+            state = 'open' if self.opened is not None else 'closed'
+            return 'Site health: breaker %s, tripped %d times, %d requests ' \
+                   'refused, %d latencies seen' % (
+                       state, self.trips, self.rejected, len(self.latencies))
+
+
+_health = SiteHealth()
+
+def get_site_health():
+    '''
+    The process-wide health record of Beam Ebooks
+    '''
+    return _health
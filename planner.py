@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+
+from Queue import Queue, Empty
+from threading import Event
+
+from calibre_plugins.beam_ebooks_metadata.health import get_site_health
+from calibre_plugins.beam_ebooks_metadata.pool import get_pool, ABORT_CHECK_INTERVAL
+from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+
+class QueryPlanner(object):
+
+    '''
+    Runs the searches planned for a book, (strategy, query) pairs best
+    first, until one of them finds a details page. The first search starts
+    right away. The next one starts when a search finds nothing, or when no
+    search has answered within the hedge delay of the site, the 95th
+    percentile of its response times. The searches still running once one
+    has found something are cancelled.
+    '''
+
+    def __init__(self, plugin, log, abort, timeout):
+        self.plugin = plugin
+        self.log = log
+        self.abort = abort
+        self.timeout = timeout
+        self.tracer = get_tracer(plugin)
+        # Set to cancel every search of this plan, abort belongs to calibre
+        # and must not be set by us
+        self.cancel = Event()
+        self.results = Queue()
+
+    def run(self, queries, title, authors, matches):
+        '''
+        Appends the urls found by the winning search to matches. Returns an
+        error message if no search found anything and one of them failed.
+        '''
+        pending = list(queries[1:])
+        running = 0
+        errors = []
+        (strategy, query) = queries[0]
+        self._start(strategy, query, title, authors)
+        running += 1
+        started = time.time()
+        while running:
+            try:
+                (strategy, found, err) = self.results.get(True, ABORT_CHECK_INTERVAL)
+            except Empty:
+                if self.abort.is_set():
+                    self.cancel.set()
+                    return None
+                if not pending or time.time() - started < get_site_health().hedge_delay():
+                    continue
+                # Nothing has come back in time, try another way as well
+                (strategy, query) = pending.pop(0)
+                self.log.debug("    Hedging with %s search: %s" % (strategy, query))
+                self.tracer.count('search_hedged')
+                self._start(strategy, query, title, authors)
+                running += 1
+                started = time.time()
+                continue
+
+            running -= 1
+            if err is not None:
+                errors.append(err)
+            if [url for url in found if url.find('/ebook/') > -1]:
+                self.log.debug("    Found by %s search" % strategy)
+                self.tracer.count('search_won_%s' % strategy)
+                self.cancel.set()
+                matches.extend(url for url in found if url not in matches)
+                return None
+            if pending and not self.abort.is_set():
+                # Nothing found this way, fall back to the next search
+                (strategy, query) = pending.pop(0)
+                self.log.debug("    Falling back to %s search: %s" % (strategy, query))
+                self.tracer.count('search_fallback')
+                self._start(strategy, query, title, authors)
+                running += 1
+                started = time.time()
+        return errors[0] if errors else None
+
+    def _start(self, strategy, query, title, authors):
+        get_pool(self.plugin).submit(self._search, strategy, query, title, authors)
+
+    def _search(self, strategy, query, title, authors):
+        found = []
+        err = None
+        try:
+            err = self.plugin._search(self.log, query, title, authors,
+                    self.cancel, self.timeout, found)
+        except Exception as e:
+            err = unicode(e)
+        finally:
+            self.results.put((strategy, found, err))
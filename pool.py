@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+
+from Queue import Queue
+from threading import Thread, Lock, Event
+
+# Seconds between looks at the abort flag while waiting for jobs
+ABORT_CHECK_INTERVAL = 0.05
+
+class TokenBucket(object):
+
+    '''
+    Rate limiter shared by everything that talks to Beam Ebooks. Tokens are
+    added at ``rate`` per second, up to ``burst`` tokens; every request takes
+    one token.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.lock = Lock()
+
+    def configure(self, rate, burst=1):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = float(rate)
+            self.burst = max(1, burst)
+            self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_acquire(self, reserve=0):
+        '''
+        Takes a token if one is available right away and at least reserve
+        more are left for others afterwards
+        '''
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens >= 1 + reserve:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self, abort=None):
+        '''
+        Blocks until a token is available. Returns False without taking a
+        token if abort gets set while waiting.
+        '''
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = (1 - self.tokens) / self.rate
+            if abort is None:
+                time.sleep(delay)
+            elif abort.wait(delay) or abort.is_set():
+                return False
+
+
+class WorkerPool(object):
+
+    '''
+    Fixed number of daemon threads running submitted jobs in order
+    '''
+
+    def __init__(self, size):
+        self.size = 0
+        self.started = 0
+        self.jobs = Queue()
+        self.lock = Lock()
+        self.resize(size)
+
+    def resize(self, size):
+        '''
+        Starts more threads, or lets some of them end once they get to the
+        jobs submitted so far
+        '''
+        size = max(1, size)
+        with self.lock:
+            for i in range(self.size, size):
+                t = Thread(target=self._run, name='BeamEbooksWorker-%d' % self.started)
+                t.daemon = True
+                t.start()
+                self.started += 1
+            for i in range(size, self.size):
+                self.jobs.put(None)
+            self.size = size
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            (func, args) = job
+            try:
+                func(*args)
+            except:
+                # Jobs do their own logging, this only keeps the thread alive
+                pass
+
+    def submit(self, func, *args):
+        self.jobs.put((func, args))
+
+
+_pool = None
+_rate_limiter = None
+_shared_lock = Lock()
+
+def get_pool(plugin):
+    '''
+    The process-wide pool that runs details downloads for every identify
+    call. Follows changes of the pool_size option.
+    '''
+    global _pool
+    size = int(plugin.prefs['pool_size'])
+    with _shared_lock:
+        if _pool is None:
+            _pool = WorkerPool(size)
+        elif _pool.size != max(1, size):
+            _pool.resize(size)
+        return _pool
+
+def get_rate_limiter(plugin):
+    '''
+    The process-wide limit on requests per minute to Beam Ebooks. Follows
+    changes of the requests_per_minute and pool_size options.
+    '''
+    global _rate_limiter
+    rate = int(plugin.prefs['requests_per_minute']) / 60.0
+    burst = int(plugin.prefs['pool_size'])
+    with _shared_lock:
+        if _rate_limiter is None:
+            _rate_limiter = TokenBucket(rate, burst=burst)
+        elif (_rate_limiter.rate, _rate_limiter.burst) != (rate, max(1, burst)):
+            _rate_limiter.configure(rate, burst=burst)
+        return _rate_limiter
+
+
+class Completion(object):
+
+    '''
+    Tracks a group of submitted jobs. ``done`` is set once every job has
+    finished, or earlier when a job reports a result that none of the others
+    could outrank.
+    '''
+
+    def __init__(self, count):
+        self.pending = count
+        self.lock = Lock()
+        self.done = Event()
+        if count == 0:
+            self.done.set()
+
+    def add(self, count):
+        with self.lock:
+            self.pending += count
+
+    def finished(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending <= 0:
+                self.done.set()
+
+    def resolve(self):
+        self.done.set()
+
+    def wait(self, abort, timeout=None):
+        '''
+        Blocks until the jobs are done, abort is set or timeout seconds have
+        passed. Returns True if the jobs are done.
+        '''
+        # abort belongs to calibre and cannot be waited on together with
+        # done, so it is looked at between short waits on done alone
+        deadline = None if timeout is None else time.time() + timeout
+        while not abort.is_set():
+            remaining = ABORT_CHECK_INTERVAL
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.time())
+                if remaining <= 0:
+                    break
+            if self.done.wait(remaining):
+                return True
+        return self.done.is_set()
+
+
+class SingleFlight(object):
+
+    '''
+    Concurrent calls for the same key share one call: the first caller runs
+    it, the others wait for its result. Nothing is remembered once the call
+    is done, that is what the caches are for.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, func, abort):
+        '''
+        Returns func() or the result of the call for key in flight. Returns
+        None if abort was set while waiting. If the running call ended
+        without a result because its own caller aborted, the call is made
+        again.
+        '''
+        while True:
+            with self.lock:
+                call = self.calls.get(key, None)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = _Call()
+                    self.leaders += 1
+            if leader:
+                try:
+                    call.result = func()
+                    return call.result
+                except Exception as e:
+                    call.error = e
+                    raise
+                finally:
+                    with self.lock:
+                        del self.calls[key]
+                    call.done.set()
+
+            while not call.done.wait(ABORT_CHECK_INTERVAL):
+                if abort.is_set():
+                    return None
+            if call.error is None and call.result is None and not abort.is_set():
+                continue
+            with self.lock:
+                self.shared += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def stats(self):
+        with self.lock:
+            return 'Single flight: %d requests made, %d shared with a request in flight' % (
+                self.leaders, self.shared)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+_single_flight = SingleFlight()
+
+def get_single_flight():
+    '''
+    The process-wide single flight of page downloads, keyed by url
+    '''
+    return _single_flight
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+from Queue import Queue
+from threading import Event, Lock, Thread
+from urllib import quote
+
+from lxml.html import fromstring
+
+from calibre.utils.cleantext import clean_ascii_chars
+
+from calibre_plugins.beam_ebooks_metadata.catalog import get_catalog
+from calibre_plugins.beam_ebooks_metadata.health import CircuitOpen
+from calibre_plugins.beam_ebooks_metadata.pool import get_rate_limiter
+from calibre_plugins.beam_ebooks_metadata.scoring import series_issue
+from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+from calibre_plugins.beam_ebooks_metadata.transport import get_transport
+from calibre_plugins.beam_ebooks_metadata.worker import Worker, read_response
+
+SERIES = 'Perry Rhodan'
+
+# Rate limiter tokens left over for real lookups, the prefetcher only takes
+# a token when more than this many are available
+RESERVE = 1
+
+class Prefetcher(object):
+
+    '''
+    Perry Rhodan issues are usually imported in order, so once issue N has
+    been identified the details pages of the next few issues are downloaded
+    in the background. Their ids come from the local catalog, or else from a
+    search for the issue number. The next identify then finds the book in
+    the catalog and its page in the details cache.
+
+    The prefetcher runs on a thread of its own and only takes rate limiter
+    tokens that are free right away, so it never delays a real lookup.
+    Issues it had no budget for are tried again the next time they come up.
+    '''
+
+    def __init__(self, plugin, depth=3):
+        self.plugin = plugin
+        self.depth = depth
+        self.queue = Queue()
+        self.seen = set()
+        self.lock = Lock()
+        self.prefetched = 0
+        self.thread = Thread(target=self._run, name='BeamEbooksPrefetcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def issue_resolved(self, log, issue):
+        for n in range(issue + 1, issue + 1 + self.depth):
+            with self.lock:
+                if n in self.seen:
+                    continue
+                self.seen.add(n)
+            self.queue.put((log, n))
+
+    def _run(self):
+        while True:
+            (log, n) = self.queue.get()
+            try:
+                done = self._prefetch(log, n)
+            except CircuitOpen:
+                done = False
+            except:
+                log.exception('Prefetching %s %d failed' % (SERIES, n))
+                done = True
+            if not done:
+                with self.lock:
+                    self.seen.discard(n)
+
+    def _prefetch(self, log, n):
+        '''
+        Returns False if the rate budget ran out before issue n was done
+        '''
+        ids = get_catalog().find_issue(SERIES, n)
+        if ids:
+            urls = ['%s/ebook/%s' % (self.plugin.BASE_URL, i) for i in ids]
+        else:
+            urls = self._search(log, n)
+            if urls is None:
+                return False
+        for url in urls:
+            if not self._warm(log, url):
+                return False
+        return True
+
+    def _search(self, log, n):
+        if not get_rate_limiter(self.plugin).try_acquire(reserve=RESERVE):
+            return None
+        query = '%s/suchergebnis.php?Type=Title&sw=%s&x=0&y=0' % (
+            self.plugin.BASE_URL, quote(('%s %d' % (SERIES, n)).encode('iso-8859-1')))
+        log.debug('    Prefetch search: %s' % query)
+        response = get_transport(self.plugin).open(query, timeout=30)
+        raw = read_response(response, Event()) if response is not None else None
+        if not raw:
+            return []
+        root = fromstring(clean_ascii_chars(raw.strip().decode('utf-8', errors='replace')))
+        if response.geturl().find('/ebook/') > -1:
+            # The site went straight to the only hit
+            return [response.geturl()]
+        return [url for (url, title, author) in self.plugin._search_hits(root)
+                if series_issue(title) == n]
+
+    def _warm(self, log, url):
+        worker = Worker(url, Queue(), None, log, 0, self.plugin, background=True)
+        raw = worker.cached_details()
+        if raw is None:
+            if worker.known_missing():
+                return True
+            if not get_rate_limiter(self.plugin).try_acquire(reserve=RESERVE):
+                return False
+            raw = worker.download_details()
+            if raw is None:
+                return True
+            worker.store_details(raw)
+            self.prefetched += 1
+            get_tracer(self.plugin).count('prefetched')
+            log.debug('    Prefetched %s' % url)
+        # Parsing adds the book to the catalog as well
+        worker.process_details(raw)
+        return True
+
+
+_prefetcher = None
+_prefetcher_lock = Lock()
+
+def get_prefetcher(plugin):
+    '''
+    The process-wide prefetcher, or None if the prefetch_issues option is 0
+    '''
+    global _prefetcher
+    depth = int(plugin.prefs['prefetch_issues'])
+    if depth <= 0:
+        return None
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = Prefetcher(plugin, depth)
+        return _prefetcher
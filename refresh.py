@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import json
+import time
+
+from threading import Event, Lock, Semaphore
+
+from lxml.html import fromstring
+
+from calibre_plugins.beam_ebooks_metadata.cache import _connect, default_cache_path, get_details_cache
+from calibre_plugins.beam_ebooks_metadata.pool import get_pool, get_rate_limiter, Completion, ABORT_CHECK_INTERVAL
+from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+from calibre_plugins.beam_ebooks_metadata.transport import get_transport
+from calibre_plugins.beam_ebooks_metadata.worker import Worker, read_details
+
+# Checked books are written to disk in batches of this many, an interrupted
+# refresh checks at most this many books again
+CHECKPOINT_INTERVAL = 100
+
+# Books in the worker pool at a time. The pool is shared with identify,
+# whose jobs only queue behind this many refresh jobs.
+WINDOW = 16
+
+def fields_digest(worker):
+    '''
+    SHA-1 of the fields a parsed details page contributes to the metadata,
+    markup changes around them do not change it
+    '''
+    fields = [worker.title, worker.series_index, worker.authors, worker.cover_url]
+    return hashlib.sha1(json.dumps(fields).encode('utf-8')).hexdigest()
+
+
+class RefreshState(object):
+
+    '''
+    What the last refresh saw of every book: the validators the site sent
+    with its details page and the digest of the fields parsed from it. A
+    run in progress is remembered under its name together with the time it
+    started, books checked since then are skipped when it is resumed.
+    '''
+
+    def __init__(self, path):
+        (self.conn, self.lock) = _connect(path)
+        self.unsaved = 0
+        with self.lock:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS refresh ('
+                'id TEXT PRIMARY KEY, etag TEXT, modified TEXT, digest TEXT, '
+                'checked REAL)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS refresh_runs ('
+                'name TEXT PRIMARY KEY, started REAL)')
+            self.conn.commit()
+
+    def begin(self, name, resume=True):
+        '''
+        Returns the time the run called name started, which is now unless an
+        interrupted run of that name is resumed
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT started FROM refresh_runs WHERE name=?',
+                    (name,)).fetchone()
+            if row is not None and resume:
+                return row[0]
+            started = time.time()
+            self.conn.execute('DELETE FROM refresh_runs WHERE name=?', (name,))
+            self.conn.execute('INSERT INTO refresh_runs (name, started) VALUES (?, ?)',
+                    (name, started))
+            self.conn.commit()
+            return started
+
+    def finish(self, name):
+        with self.lock:
+            self.conn.execute('DELETE FROM refresh_runs WHERE name=?', (name,))
+            self.conn.commit()
+            self.unsaved = 0
+
+    def checked_since(self, started):
+        '''
+        The ids of the books checked since started
+        '''
+        with self.lock:
+            return set(row[0] for row in self.conn.execute(
+                'SELECT id FROM refresh WHERE checked >= ?', (started,)))
+
+    def get(self, beam_ebooks_id):
+        '''
+        Returns (etag, modified, digest) as last seen, or None
+        '''
+        with self.lock:
+            return self.conn.execute(
+                'SELECT etag, modified, digest FROM refresh WHERE id=?',
+                (beam_ebooks_id,)).fetchone()
+
+    def record(self, beam_ebooks_id, etag, modified, digest):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO refresh (id, etag, modified, digest, checked) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (beam_ebooks_id, etag, modified, digest, time.time()))
+            self.unsaved += 1
+            if self.unsaved >= CHECKPOINT_INTERVAL:
+                self.conn.commit()
+                self.unsaved = 0
+
+    def save(self):
+        with self.lock:
+            self.conn.commit()
+            self.unsaved = 0
+
+
+class LibraryRefresh(object):
+
+    '''
+    Checks the details pages of many books for changes. Pages are requested
+    with If-None-Match and If-Modified-Since when the site sent an ETag or a
+    Last-Modified header last time, so unchanged pages are not downloaded
+    again. Pages that are downloaded count as changed only if the fields
+    parsed from them differ from the last refresh, or from the details cache
+    for books not refreshed before. Only the Metadata of changed books is put
+    on the result queue.
+
+    Progress is saved every CHECKPOINT_INTERVAL books; running a refresh of
+    the same name again after it was interrupted skips the books it already
+    checked. Books are handed to the shared worker pool window at a time,
+    so lookups started during a refresh are not stuck behind all of it.
+    '''
+
+    def __init__(self, plugin, log, abort=None, timeout=30, name='library',
+                 window=WINDOW):
+        self.plugin = plugin
+        self.log = log
+        self.abort = abort if abort is not None else Event()
+        self.timeout = timeout
+        self.name = name
+        self.window = window
+        self.state = get_refresh_state()
+        self.tracer = get_tracer(plugin)
+        self.lock = Lock()
+        self.counts = dict((k, 0) for k in
+                ('resumed', 'not_modified', 'unchanged', 'changed', 'missing', 'failed'))
+
+    def run(self, beam_ebooks_ids, result_queue, resume=True):
+        '''
+        Returns the number of books put on result_queue
+        '''
+        ids = list(beam_ebooks_ids)
+        started = self.state.begin(self.name, resume=resume)
+        done = self.state.checked_since(started)
+        pending = [i for i in ids if i not in done]
+        self.counts['resumed'] = len(ids) - len(pending)
+        if self.counts['resumed']:
+            self.log.info('Refresh %s: resuming, %d of %d books already checked' % (
+                self.name, self.counts['resumed'], len(ids)))
+
+        self.completion = Completion(len(pending))
+        self.slots = Semaphore(self.window)
+        pool = get_pool(self.plugin)
+        for beam_ebooks_id in pending:
+            while not self.slots.acquire(False):
+                if self.abort.is_set():
+                    break
+                time.sleep(ABORT_CHECK_INTERVAL)
+            if self.abort.is_set():
+                break
+            pool.submit(self._check, beam_ebooks_id, result_queue)
+        self.completion.wait(self.abort)
+
+        if self.abort.is_set():
+            self.state.save()
+        else:
+            self.state.finish(self.name)
+        self.log.info('    %s' % self.stats())
+        return self.counts['changed']
+
+    def _check(self, beam_ebooks_id, result_queue):
+        try:
+            if not self.abort.is_set():
+                self._refresh(beam_ebooks_id, result_queue)
+        except:
+            self.log.exception('Refreshing %s failed' % beam_ebooks_id)
+            self._count('failed')
+        finally:
+            self.slots.release()
+            self.completion.finished()
+
+    def _refresh(self, beam_ebooks_id, result_queue):
+        url = '%s/ebook/%s' % (self.plugin.BASE_URL, beam_ebooks_id)
+        worker = Worker(url, result_queue, None, self.log, 0, self.plugin,
+                timeout=self.timeout, abort=self.abort, background=True)
+        worker.beam_ebooks_id = beam_ebooks_id
+        last = self.state.get(beam_ebooks_id)
+        headers = {}
+        if last is not None and last[0]:
+            headers['If-None-Match'] = last[0]
+        if last is not None and last[1]:
+            headers['If-Modified-Since'] = last[1]
+
+        if not get_rate_limiter(self.plugin).acquire(self.abort):
+            return
+        try:
+            with self.tracer.phase('details_fetch'):
+                response = get_transport(self.plugin).open(url, timeout=self.timeout,
+                        abort=self.abort, headers=headers)
+                if response is None:
+                    return
+                code = response.getcode()
+                raw = read_details(response, self.abort)
+            if raw is None:
+                return
+        except Exception as e:
+            worker.download_failed(e)
+            self._count('failed')
+            return
+
+        if code == 304:
+            self.state.record(beam_ebooks_id, last[0], last[1], last[2])
+            self._count('not_modified')
+            return
+        etag = response.info().getheader('etag')
+        modified = response.info().getheader('last-modified')
+
+        raw = worker.decode_details(raw)
+        if raw is None:
+            # The site does not know the book any more
+            self.state.record(beam_ebooks_id, etag, modified, None)
+            self._count('missing')
+            return
+        if last is not None:
+            previous = last[2]
+        else:
+            # Not refreshed before, compare with the page identify saw
+            cached = get_details_cache(self.plugin).get(beam_ebooks_id)
+            previous = self._digest(worker, cached) if cached is not None else None
+        digest = self._digest(worker, raw)
+        if digest is None:
+            self._count('failed')
+            return
+
+        worker.store_details(raw)
+        self.state.record(beam_ebooks_id, etag, modified, digest)
+        if digest == previous:
+            self._count('unchanged')
+            return
+        with self.tracer.phase('metadata_build'):
+            result_queue.put(worker.build_metadata())
+        self._count('changed')
+
+    def _digest(self, worker, raw):
+        # Parses raw into the fields of worker, build_metadata uses the page
+        # parsed last
+        with self.tracer.phase('parse'):
+            try:
+                root = fromstring(raw)
+            except:
+                self.log.exception('Failed to parse beam ebooks details page: %r' % worker.url)
+                return None
+            worker.parse_details(root)
+            worker.cover_url = worker.parse_cover_url(root)
+        return fields_digest(worker)
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        return 'Refresh %s: %d not modified, %d unchanged, %d changed, ' \
+               '%d missing, %d failed, %d checked before' % (
+                   self.name, self.counts['not_modified'], self.counts['unchanged'],
+                   self.counts['changed'], self.counts['missing'],
+                   self.counts['failed'], self.counts['resumed'])
+
+
+_refresh_state = None
+_refresh_state_lock = Lock()
+
+def get_refresh_state():
+    '''
+    The process-wide refresh state, kept next to the page caches
+    '''
+    global _refresh_state
+    with _refresh_state_lock:
+        if _refresh_state is None:
+            _refresh_state = RefreshState(default_cache_path())
+        return _refresh_state
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+
+from difflib import SequenceMatcher
+
+from calibre_plugins.beam_ebooks_metadata.titles import series_rules
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Share of the score that comes from the author, when authors are known
+AUTHOR_WEIGHT = 0.25
+
+# The title of a hit has to score this much on its own before its author
+# counts. Unrelated titles share enough letters to score about 0.4.
+MIN_TITLE_SCORE = 0.5
+
+def normalize(text):
+    return ' '.join(w.lower() for w in WORD.findall(text or ''))
+
+def strip_series(title):
+    # Series decorations appear on only one side of a comparison, in the
+    # book titles of calibre, on the search result page or on the details page
+    return series_rules.apply((title or '').strip())[0]
+
+def series_issue(title):
+    '''
+    The Perry Rhodan issue number in title, or None
+    '''
+    return series_rules.apply((title or '').strip())[1]
+
+def similarity(a, b):
+    if not a or not b:
+        return 0.0
+    matcher = SequenceMatcher(None, a, b)
+    # quick_ratio() is an upper bound of ratio() and much cheaper
+    if matcher.quick_ratio() < 0.3:
+        return 0.0
+    return matcher.ratio()
+
+def word_similarity(a, b):
+    '''
+    Share of the words the two titles have in common, between 0 and 1
+    '''
+    a = set(a.split())
+    b = set(b.split())
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+def title_score(a, b):
+    # Letters catch spelling variants, words keep titles apart that merely
+    # share letters
+    return (similarity(a, b) + word_similarity(a, b)) / 2
+
+def score_candidate(orig_title, orig_authors, title, author):
+    '''
+    How well a search hit with title and author matches the book being
+    identified, between 0 and 1
+    '''
+    wanted = normalize(strip_series(orig_title))
+    score = max(title_score(wanted, normalize(title)),
+                title_score(wanted, normalize(strip_series(title))))
+    if score < MIN_TITLE_SCORE:
+        # A matching author alone does not make it the same book
+        return score
+    if orig_authors:
+        found = normalize(author)
+        author_score = max(similarity(normalize(a), found) for a in orig_authors)
+        score = (1 - AUTHOR_WEIGHT) * score + AUTHOR_WEIGHT * author_score
+    return score
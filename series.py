@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import os
+
+from bisect import bisect_right
+from threading import Lock
+
+SERIES_RESOURCE = 'series.txt'
+
+class SeriesIndex(object):
+
+    '''
+    Sorted interval index from issue numbers to cycle names, for any number
+    of series. Lookups bisect the start of the intervals, so they take
+    O(log n) per issue no matter how many cycles a series has.
+    '''
+
+    def __init__(self, rows):
+        by_series = {}
+        for (series, first, last, cycle) in rows:
+            by_series.setdefault(series, []).append((first, last, cycle))
+        self.series = {}
+        for series, intervals in by_series.iteritems():
+            intervals.sort()
+            for previous, current in zip(intervals, intervals[1:]):
+                if current[0] <= previous[1]:
+                    raise ValueError('Overlapping cycles in %s: %s and %s' % (
+                        series, previous[2], current[2]))
+            self.series[series] = ([i[0] for i in intervals],
+                                   [i[1] for i in intervals],
+                                   [i[2] for i in intervals])
+
+    def cycle(self, series, issue):
+        '''
+        The name of the cycle issue belongs to, or None
+        '''
+        intervals = self.series.get(series, None)
+        if intervals is None or issue is None:
+            return None
+        (starts, ends, cycles) = intervals
+        i = bisect_right(starts, issue) - 1
+        if i >= 0 and issue <= ends[i]:
+            return cycles[i]
+        return None
+
+    def cycles(self, series, issues):
+        '''
+        The cycle names for many issues of one series, in the same order
+        '''
+        return [self.cycle(series, issue) for issue in issues]
+
+
+def parse_series_table(data):
+    rows = []
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        (series, first, last, cycle) = [f.strip() for f in line.split('|')]
+        rows.append((series, int(first), int(last), cycle))
+    return rows
+
+
+_series_index = None
+_series_index_lock = Lock()
+
+def get_series_index(plugin):
+    '''
+    The series index loaded from series.txt, once per process
+    '''
+    global _series_index
+    with _series_index_lock:
+        if _series_index is None:
+            data = None
+            try:
+                data = plugin.load_resources([SERIES_RESOURCE]).get(SERIES_RESOURCE, None)
+            except:
+                pass
+            if data is None:
+                # Running from a source checkout instead of the plugin zip
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       SERIES_RESOURCE), 'rb') as f:
+                    data = f.read()
+            _series_index = SeriesIndex(parse_series_table(data.decode('utf-8')))
+        return _series_index
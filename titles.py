@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import re
+
+from string import Formatter
+from threading import Lock
+
+# A rule is a regular expression and the template its match is replaced
+# with. Templates use str.format(), with {title} and {issue} for the named
+# groups of the expression, e.g. 'PR{issue:04d} - {title}'. An issue group
+# also gives the series index. The first rule that matches wins.
+
+# Titles on the details pages, rewritten to the PRnnnn - Title convention
+DETAILS_RULES = [
+    # Der Einsame der Zeit - Perry Rhodan 50
+    (r'^(?P<title>.*?)\s+-\s+Perry Rhodan\s+(?P<issue>\d+)\s*$', 'PR{issue:04d} - {title}'),
+    # PERRY RHODAN-Heftroman 2601: Galaxis in Aufruhr
+    (r'PERRY RHODAN-Heftroman\s+(?P<issue>\d+)\s*:\s*(?P<title>.*)$', 'PR{issue:04d} - {title}'),
+]
+
+# Titles of calibre books, stripped down to what the site can search for
+QUERY_RULES = [
+    # PR2500 - Projekt Saturn, and PR0007-Invasion aus dem All of the old
+    # convention
+    (r'^PR\s*(?P<issue>\d+)\s*-\s*(?P<title>.*)$', '{title}'),
+]
+
+# Any of the conventions, stripped from titles before they are compared
+SERIES_RULES = [(pattern, '{title}') for (pattern, template) in
+                QUERY_RULES + DETAILS_RULES]
+
+# Separates the rules of the title_rules option, each written as
+# pattern => template
+RULE_SEPARATOR = ';;'
+TEMPLATE_SEPARATOR = '=>'
+
+class TitleRules(object):
+
+    '''
+    Title rewriting driven by a table of (pattern, template) rules, see
+    DETAILS_RULES. The patterns are compiled once.
+    '''
+
+    def __init__(self, rules, ignore_case=False):
+        flags = re.UNICODE | (re.IGNORECASE if ignore_case else 0)
+        self.rules = [(re.compile(pattern, flags), template)
+                      for (pattern, template) in rules]
+
+    def apply(self, title):
+        '''
+        Returns (title, issue), with issue None if no rule gave one. Titles
+        no rule matches are returned unchanged.
+        '''
+        if not title:
+            return (title, None)
+        for (regex, template) in self.rules:
+            match = regex.search(title)
+            if match is None:
+                continue
+            fields = dict((k, v or '') for (k, v) in match.groupdict().iteritems())
+            issue = int(fields['issue']) if fields.get('issue', None) else None
+            fields['issue'] = issue
+            try:
+                return (template.format(**fields).strip(), issue)
+            except (ValueError, KeyError, IndexError, AttributeError):
+                # e.g. {issue:04d} where the issue group did not take part
+                # in the match, the next rule may still do
+                continue
+        return (title, None)
+
+    def apply_many(self, titles):
+        '''
+        apply() for a batch of titles, returns the (title, issue) pairs in
+        the same order. Repeated titles are only rewritten once.
+        '''
+        done = {}
+        apply = self.apply
+        results = []
+        for title in titles:
+            result = done.get(title, None)
+            if result is None:
+                result = done[title] = apply(title)
+            results.append(result)
+        return results
+
+
+def parse_rules(text):
+    '''
+    The (pattern, template) rules written in the title_rules option
+    '''
+    rules = []
+    for rule in (text or '').split(RULE_SEPARATOR):
+        if not rule.strip():
+            continue
+        (pattern, sep, template) = rule.partition(TEMPLATE_SEPARATOR)
+        if not sep:
+            raise ValueError('Title rule without %s: %r' % (TEMPLATE_SEPARATOR, rule))
+        (pattern, template) = (pattern.strip(), template.strip())
+        groups = re.compile(pattern, re.UNICODE).groupindex
+        for (literal, field, spec, conversion) in Formatter().parse(template):
+            if field is None:
+                continue
+            name = re.split(r'[.\[]', field, 1)[0]
+            if name not in groups:
+                raise ValueError('Title rule template uses {%s}, which is not a '
+                                 'named group of its pattern: %r' % (field, rule))
+        rules.append((pattern, template))
+    return rules
+
+
+query_rules = TitleRules(QUERY_RULES)
+series_rules = TitleRules(SERIES_RULES, ignore_case=True)
+
+_details_rules = None
+_details_rules_text = None
+_details_rules_lock = Lock()
+
+def get_details_rules(plugin, log):
+    '''
+    The rules for details page titles: those of the title_rules option
+    first, then the built-in ones. Rebuilt when the option changes.
+    '''
+    global _details_rules, _details_rules_text
+    text = plugin.prefs['title_rules']
+    with _details_rules_lock:
+        if _details_rules is None or text != _details_rules_text:
+            try:
+                _details_rules = TitleRules(parse_rules(text) + DETAILS_RULES)
+            except (ValueError, re.error) as e:
+                log.error('Ignoring the title rules option: %s' % e)
+                _details_rules = TitleRules(DETAILS_RULES)
+            _details_rules_text = text
+        return _details_rules
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import time
+
+from bisect import bisect_left
+from threading import Lock
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket
+# takes everything slower
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# The phases of a lookup, in the order they are reported
+PHASES = ('query_build', 'search_fetch', 'search_parse', 'details_fetch',
+          'decode', 'parse', 'metadata_build')
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        self.n += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for (a, b) in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        '''
+        Upper bound of the bucket holding the p-th percentile, in ms
+        '''
+        wanted = self.n * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max * 1000
+        return 0.0
+
+    def summary(self):
+        return 'n=%d mean %.1f ms p50 <%g ms p90 <%g ms max %.1f ms' % (
+            self.n, self.total / max(self.n, 1) * 1000,
+            self.percentile(50), self.percentile(90), self.max * 1000)
+
+
+class _Span(object):
+
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.record(self.name, time.time() - self.start)
+        return False
+
+
+class Tracer(object):
+
+    '''
+    Collects the duration of each phase of a lookup into histograms, plus
+    named counters, for all threads of the process. Each dump reports what
+    was recorded since the one before, the totals since the last reset are
+    kept as well.
+    '''
+
+    enabled = True
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+            self.total_histograms = {}
+            self.total_counters = {}
+            self.total_started = self.started
+
+    def phase(self, name):
+        '''
+        Context manager timing one phase
+        '''
+        return _Span(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name, None)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def dump(self, log, totals=False):
+        '''
+        Logs what was recorded since the last dump, or with totals
+        everything since the last reset, and starts over
+        '''
+        with self.lock:
+            (histograms, counters, started) = (self.histograms, self.counters, self.started)
+            for (name, histogram) in histograms.iteritems():
+                self.total_histograms.setdefault(name, Histogram()).merge(histogram)
+            for (name, n) in counters.iteritems():
+                self.total_counters[name] = self.total_counters.get(name, 0) + n
+            if totals:
+                (histograms, counters, started) = (self.total_histograms,
+                        self.total_counters, self.total_started)
+            log.info('Trace of the last %.1f s:' % (time.time() - started))
+            names = [p for p in PHASES if p in histograms]
+            names += sorted(set(histograms) - set(PHASES))
+            for name in names:
+                log.info('    %-16s %s' % (name, histograms[name].summary()))
+            for name in sorted(counters):
+                log.info('    %-16s %d' % (name, counters[name]))
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+
+
+class _NullSpan(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class NullTracer(object):
+
+    '''
+    Stands in for the Tracer while tracing is off, every call does nothing
+    '''
+
+    enabled = False
+
+    _span = _NullSpan()
+
+    def reset(self):
+        pass
+
+    def phase(self, name):
+        return self._span
+
+    def record(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def dump(self, log, totals=False):
+        pass
+
+
+_tracer = Tracer()
+_null_tracer = NullTracer()
+
+def get_tracer(plugin):
+    '''
+    The process-wide tracer, or one that records nothing when the
+    enable_tracing option is off
+    '''
+    return _tracer if plugin.prefs['enable_tracing'] else _null_tracer
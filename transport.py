@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2011, Hakan Tandogan <hakan@gurkensalat.com>'
+__docformat__ = 'restructuredtext en'
+
+import socket
+import time
+import zlib
+
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from threading import Lock, Semaphore
+from urllib import getproxies, proxy_bypass
+from urllib2 import HTTPError
+from urlparse import urlsplit, urljoin
+
+from calibre_plugins.beam_ebooks_metadata.health import get_site_health
+from calibre_plugins.beam_ebooks_metadata.pool import ABORT_CHECK_INTERVAL
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:7.0.1) Gecko/20100101 Firefox/7.0.1'
+
+MAX_REDIRECTS = 5
+
+READ_SIZE = 16 * 1024
+
+# Idle connections older than this are not used again, the site closes
+# them on its side before long
+KEEPALIVE_SECONDS = 15
+
+REDIRECT_CODES = (301, 302, 303, 307)
+
+def route(url, proxies):
+    '''
+    Returns ((scheme, host, port), path, host header) for a request of url:
+    where to connect to and what to ask for
+    '''
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    # Plain http goes through the proxy of the environment, like the
+    # calibre browser does
+    proxy = proxies.get(parts.scheme, None)
+    if proxy and parts.scheme == 'http' and not proxy_bypass(parts.hostname):
+        proxy = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+        return (('http', proxy.hostname, proxy.port or 80), url, parts.netloc)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    return ((parts.scheme, parts.hostname, port), path, parts.netloc)
+
+
+class Interrupt(object):
+
+    '''
+    Lets another thread cut a request short: fire() shuts down the socket
+    the request is waiting on, so a read blocked on it returns at once
+    instead of at the timeout. Pass it as the abort of
+    :meth:`ConnectionPool.open`. Requests cut short do not count as failures
+    of the site.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sock = None
+        self.fired = False
+
+    def is_set(self):
+        return self.fired
+
+    def fire(self):
+        with self.lock:
+            self.fired = True
+            sock = self.sock
+        if sock is not None:
+            _shutdown(sock)
+
+    def attach(self, sock):
+        with self.lock:
+            self.sock = sock
+            fired = self.fired
+        if fired:
+            _shutdown(sock)
+
+    def detach(self):
+        '''
+        Returns True if the socket may have been shut down
+        '''
+        with self.lock:
+            self.sock = None
+            return self.fired
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+class PooledResponse(object):
+
+    '''
+    The body of one response, read like the responses of the calibre
+    browser. Gzipped bodies are inflated while they are read. Once the body
+    has been read to the end the connection goes back to the pool.
+
+    The request counts as a success for the site health only then, with
+    elapsed, the time the headers took, as its response time. A read that
+    fails counts as a failure, so a site that sends headers and then stalls
+    trips the breaker.
+    '''
+
+    def __init__(self, pool, key, conn, response, url, elapsed, interrupt=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.elapsed = elapsed
+        self.interrupt = interrupt
+        self.decompressor = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.response.status
+
+    def info(self):
+        return self.response.msg
+
+    def read(self, size=-1):
+        if self.conn is None:
+            return b''
+        try:
+            if self.decompressor is None:
+                data = self.response.read(size) if size >= 0 else self.response.read()
+            else:
+                data = b''
+                while not data:
+                    raw = self.response.read(size) if size >= 0 else self.response.read()
+                    if not raw:
+                        data = self.decompressor.flush()
+                        break
+                    data = self.decompressor.decompress(raw)
+        except Exception as e:
+            # A body cut off by a timeout or a reset leaves the connection
+            # useless, closing it frees its slot for the next request
+            if isinstance(e, (HTTPException, socket.error)) and not self._interrupted():
+                get_site_health().failed()
+            self.close(reusable=False)
+            raise
+        if not data:
+            if not self._interrupted():
+                get_site_health().succeeded(self.elapsed)
+            self.close()
+        return data
+
+    def _interrupted(self):
+        return self.interrupt is not None and self.interrupt.is_set()
+
+    def discard(self, limit):
+        '''
+        Done with the body before its end: the rest is read and dropped if
+        the site said it is no more than limit bytes, so the connection can
+        be used again. Otherwise the connection is closed.
+        '''
+        if self.conn is None:
+            return
+        left = self.response.length
+        if left is None or left > limit:
+            get_site_health().succeeded(self.elapsed)
+            self.close(reusable=False)
+            return
+        while self.read(READ_SIZE):
+            pass
+
+    def close(self, reusable=True):
+        if self.conn is None:
+            return
+        (conn, self.conn) = (self.conn, None)
+        # A body that was not read to the end leaves the connection in an
+        # unknown state, so it is only reused after a complete read. httplib
+        # never marks an empty body such as that of a 304 as read.
+        done = self.response.isclosed() or self.response.length == 0
+        reusable = reusable and done and not self.response.will_close
+        if self.interrupt is not None and self.interrupt.detach():
+            reusable = False
+        self.pool._release(self.key, conn, reusable)
+
+
+class ConnectionPool(object):
+
+    '''
+    Persistent keep-alive connections to the site, shared by the searches
+    and the details downloads of every lookup. At most max_connections are
+    in use at the same time; idle connections are kept for the next request
+    to the same host.
+    '''
+
+    def __init__(self, max_connections=4, user_agent=USER_AGENT):
+        self.max_connections = max_connections
+        self.slots = Semaphore(max_connections)
+        self.user_agent = user_agent
+        self.proxies = getproxies()
+        self.idle = {}
+        self.closed = False
+        self.lock = Lock()
+        self.requests = 0
+        self.connects = 0
+        self.reuses = 0
+        self.retries = 0
+        self.connect_time = 0.0
+
+    def open(self, url, timeout=30, abort=None, headers=None):
+        '''
+        GETs url, following redirects. Raises HTTPError for error statuses,
+        returns None if abort was set while waiting for a free connection.
+        headers are sent in addition to the usual ones, for conditional
+        requests; a 304 answer is returned like any other response. abort
+        may be an :class:`Interrupt`.
+        '''
+        for i in range(MAX_REDIRECTS + 1):
+            response = self._request(url, timeout, abort, headers)
+            if response is None:
+                return None
+            code = response.getcode()
+            location = response.info().getheader('location')
+            if code in REDIRECT_CODES and location:
+                # Read the rest of the body, so that the connection is reused
+                while response.read(READ_SIZE):
+                    pass
+                url = urljoin(url, location)
+                continue
+            if code >= 400:
+                response.close()
+                raise HTTPError(url, code, response.response.reason, response.info(), None)
+            return response
+        response.close()
+        raise HTTPError(url, code, 'Too many redirects', response.info(), None)
+
+    def _request(self, url, timeout, abort, extra_headers=None):
+        # Fails at once while the site is considered down, and waits for
+        # less than timeout once its usual response times are known
+        health = get_site_health()
+        health.check()
+        timeout = health.timeout(timeout)
+        (key, path, host) = route(url, self.proxies)
+        headers = {
+            'Host': host,
+            'User-Agent': self.user_agent,
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+        if extra_headers:
+            headers.update(extra_headers)
+        interrupt = abort if isinstance(abort, Interrupt) else None
+        while not self.slots.acquire(False):
+            if abort is not None and abort.is_set():
+                return None
+            time.sleep(ABORT_CHECK_INTERVAL)
+        try:
+            for attempt in (0, 1):
+                start = time.time()
+                (conn, reused) = self._get(key, timeout)
+                if interrupt is not None:
+                    interrupt.attach(conn.sock)
+                try:
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                except (HTTPException, socket.error) as e:
+                    conn.close()
+                    # The site may have closed an idle connection just as it
+                    # was taken from the pool, that deserves one more try
+                    if reused and attempt == 0 and not isinstance(e, socket.timeout) \
+                            and not (abort is not None and abort.is_set()):
+                        with self.lock:
+                            self.retries += 1
+                        continue
+                    raise
+                if response.status >= 500:
+                    health.failed()
+                return PooledResponse(self, key, conn, response, url,
+                        time.time() - start, interrupt)
+        except (HTTPException, socket.error):
+            if interrupt is None or not interrupt.detach():
+                health.failed()
+            self.slots.release()
+            raise
+        except:
+            if interrupt is not None:
+                interrupt.detach()
+            self.slots.release()
+            raise
+
+    def _get(self, key, timeout):
+        conn = None
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            idle = self.idle.get(key, [])
+            while idle and conn is None:
+                (released, conn) = idle.pop()
+                if now - released > KEEPALIVE_SECONDS:
+                    conn.close()
+                    conn = None
+            if conn is not None:
+                self.reuses += 1
+        if conn is not None:
+            conn.sock.settimeout(timeout)
+            return (conn, True)
+
+        (scheme, hostname, port) = key
+        connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        conn = connection_class(hostname, port, timeout=timeout)
+        start = time.time()
+        conn.connect()
+        elapsed = time.time() - start
+        with self.lock:
+            self.connects += 1
+            self.connect_time += elapsed
+        return (conn, False)
+
+    def _release(self, key, conn, reusable):
+        if reusable and not self.closed:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.max_connections:
+                    idle.append((time.time(), conn))
+                    conn = None
+        if conn is not None:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        '''
+        Closes the idle connections, connections in use are closed once
+        their response has been read
+        '''
+        with self.lock:
+            self.closed = True
+            (idle, self.idle) = (self.idle, {})
+        for connections in idle.itervalues():
+            for (released, conn) in connections:
+                conn.close()
+
+    def stats(self):
+        with self.lock:
+            reused = self.reuses * 100.0 / max(self.requests, 1)
+            connect_ms = self.connect_time * 1000 / max(self.connects, 1)
+            return 'HTTP: %d requests, %d connections opened, %.0f%% reused, ' \
+                   '%d retried, %.1f ms mean connect time' % (
+                       self.requests, self.connects, reused, self.retries, connect_ms)
+
+_transport = None
+_transport_lock = Lock()
+
+def get_transport(plugin):
+    '''
+    The process-wide connection pool for requests to Beam Ebooks. A new one
+    replaces it when the max_connections option changes, requests still
+    running on the old one finish there.
+    '''
+    global _transport
+    max_connections = int(plugin.prefs['max_connections'])
+    with _transport_lock:
+        if _transport is not None and _transport.max_connections != max_connections:
+            _transport.close()
+            _transport = None
+        if _transport is None:
+            _transport = ConnectionPool(max_connections)
+        return _transport
@@ -9,101 +9,550 @@ __docformat__ = 'restructuredtext en'
 
 import socket
 import re
+import time
 
-from threading import Thread
+from Queue import Queue
+from threading import Event, Lock, Thread
+from urlparse import urljoin
 
+from lxml.etree import HTMLParser, XPath
 from lxml.html import fromstring, tostring
 
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.library.comments import sanitize_comments_html
 from calibre.utils.cleantext import clean_ascii_chars
 
-class Worker(Thread): # Get details
+from calibre_plugins.beam_ebooks_metadata.cache import get_details_cache, get_missing_cache
+from calibre_plugins.beam_ebooks_metadata.catalog import disable_catalog, get_catalog, use_catalog
+from calibre_plugins.beam_ebooks_metadata.health import CircuitOpen, get_site_health
+from calibre_plugins.beam_ebooks_metadata.pool import get_rate_limiter, get_single_flight, ABORT_CHECK_INTERVAL
+from calibre_plugins.beam_ebooks_metadata.series import get_series_index
+from calibre_plugins.beam_ebooks_metadata.titles import get_details_rules
+from calibre_plugins.beam_ebooks_metadata.tracing import get_tracer
+from calibre_plugins.beam_ebooks_metadata.transport import Interrupt, get_transport
+
+READ_CHUNK_SIZE = 16 * 1024
+
+# Details pages are read in smaller chunks, so that the download stops soon
+# after the metadata block, and never past MAX_DETAILS_SIZE bytes
+DETAILS_CHUNK_SIZE = 4 * 1024
+MAX_DETAILS_SIZE = 256 * 1024
+
+# When at most this many bytes of a details page are left once the
+# metadata block is in, they are read anyway so the connection is kept
+DRAIN_LIMIT = 16 * 1024
+
+# The details page has the title in the first <strong> of the heading, and
+# links to the author pages either directly in the table cell or in a
+# paragraph inside it. The expressions are compiled once per process.
+_TITLE = '(//tr/td/div/h1/strong)[1]'
+_AUTHORS = ('//tr/td/p/a[contains(@href, "/autoreninfo.php")]'
+            ' | //tr/td/a[contains(@href, "/autoreninfo.php")]')
+TITLE_XPATH = XPath(_TITLE)
+AUTHORS_XPATH = XPath(_AUTHORS)
+DETAILS_XPATH = XPath(_TITLE + ' | ' + _AUTHORS)
+COVER_XPATH = XPath('(//img[contains(@src, "/images/cover/")])[1]/@src')
+
+def extract_details(root):
+    '''
+    Pulls the raw title and the authors out of a details page with a single
+    evaluation of DETAILS_XPATH
+    '''
+    title = None
+    authors = []
+    for node in DETAILS_XPATH(root):
+        if node.tag == 'strong':
+            if title is None:
+                title = node.text_content().strip()
+        else:
+            authors.append(node.text_content().strip())
+    return (title, authors)
+
+def read_response(response, abort):
+    '''
+    Reads the response body in chunks, so that setting abort cancels a
+    download in flight. Returns None if it was aborted.
+    '''
+    chunks = []
+    while True:
+        if abort.is_set():
+            response.close()
+            return None
+        chunk = response.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+class DetailsCutoff(object):
 
     '''
-    Get book details from Beam Ebooks book page in a separate thread
+    Watches a details page go by, chunk by chunk, for the end of the
+    metadata block: the end of the table holding the title. Its later rows
+    may still list more authors or translators, so no earlier row is taken
+    for the end. The chunks go through an lxml parser with this object as
+    its target, so no tree is built.
     '''
 
-    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
-        Thread.__init__(self)
-        self.daemon = True
+    def __init__(self):
+        self.parser = HTMLParser(target=self, encoding='iso-8859-1')
+        self.size = 0
+        self.in_heading = False
+        self.title_seen = False
+        self.tables = 0
+        self.title_table = None
+        self.done = False
+
+    def feed(self, chunk):
+        '''
+        Returns True once the metadata block is complete or the page has
+        reached MAX_DETAILS_SIZE
+        '''
+        self.size += len(chunk)
+        if self.parser is not None and not self.done:
+            try:
+                self.parser.feed(chunk)
+            except:
+                # Then the page is read up to the size limit
+                self.parser = None
+        return self.done or self.size >= MAX_DETAILS_SIZE
+
+    # The parser target interface
+
+    def start(self, tag, attrib):
+        if tag == 'h1':
+            self.in_heading = True
+        elif tag == 'strong' and self.in_heading and not self.title_seen:
+            self.title_seen = True
+            self.title_table = self.tables
+        elif tag == 'table':
+            self.tables += 1
+
+    def end(self, tag):
+        if tag == 'h1':
+            self.in_heading = False
+        elif tag == 'table':
+            if self.title_seen and self.tables == self.title_table:
+                self.done = True
+            self.tables -= 1
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.done
+
+def read_details(response, abort):
+    '''
+    :func:`read_response` for details pages, which stops reading at the end
+    of the metadata block. Returns the part of the page that was read, or
+    None if it was aborted.
+    '''
+    cutoff = DetailsCutoff()
+    chunks = []
+    while True:
+        if abort.is_set():
+            response.close()
+            return None
+        chunk = response.read(DETAILS_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if cutoff.feed(chunk):
+            response.discard(DRAIN_LIMIT)
+            break
+    return b''.join(chunks)
+
+def cut_details(raw):
+    '''
+    The part of a details page downloaded in full that
+    :func:`read_details` would have kept
+    '''
+    cutoff = DetailsCutoff()
+    for start in range(0, len(raw), DETAILS_CHUNK_SIZE):
+        end = start + DETAILS_CHUNK_SIZE
+        if cutoff.feed(raw[start:end]):
+            return raw[:end]
+    return raw
+
+def hedged_fetch(plugin, url, timeout, abort, read=read_response):
+    '''
+    Downloads url through the connection pool and returns (url after
+    redirects, body), or None if abort was set. If the answer takes longer
+    than the hedge delay of the site, the request is sent once more on
+    another connection, provided the rate limiter has a token to spare, and
+    the first complete answer wins. Raises the error of the request if it
+    failed. The body is read with read(response, abort).
+    '''
+    if not plugin.prefs['hedge_requests']:
+        response = get_transport(plugin).open(url, timeout=timeout, abort=abort)
+        raw = read(response, abort) if response is not None else None
+        return (response.geturl(), raw) if raw is not None else None
+    return HedgedFetch(plugin, url, timeout, abort, read).run()
+
+class HedgedFetch(object):
+
+    '''
+    One download of :func:`hedged_fetch`. The request is sent from the
+    calling thread, a hedge gets a thread of its own and is started by the
+    hedge timer. Whichever answers first cuts the other one short through
+    its :class:`Interrupt`.
+    '''
+
+    def __init__(self, plugin, url, timeout, abort, read):
+        self.plugin = plugin
+        self.url = url
+        self.timeout = timeout
+        self.abort = abort
+        self.read = read
+        self.results = Queue()
+        self.lock = Lock()
+        self.attempts = []
+        self.running = 0
+        self.hedged = False
+        # Set once the first request is done, no hedge is started after it
+        self.closed = False
+        self.started = time.time()
+
+    def run(self):
+        timer = get_hedge_timer()
+        timer.watch(self)
+        try:
+            with self.lock:
+                interrupt = self._add_attempt()
+            self._attempt(interrupt)
+            with self.lock:
+                self.closed = True
+            error = None
+            while True:
+                (location, raw, e) = self.results.get()
+                with self.lock:
+                    self.running -= 1
+                    running = self.running
+                if raw is not None:
+                    return (location, raw)
+                error = error or e
+                if not running:
+                    break
+        finally:
+            timer.unwatch(self)
+            self._interrupt()
+        if self.abort.is_set() or error is None:
+            return None
+        raise error
+
+    def check(self):
+        '''
+        Called by the hedge timer while the download is in flight
+        '''
+        if self.abort.is_set():
+            self._interrupt()
+            return
+        with self.lock:
+            if self.hedged or self.closed:
+                return
+            if time.time() - self.started < get_site_health().hedge_delay():
+                return
+            self.hedged = True
+        # Hedges are extra requests, they never wait for the rate limiter
+        # and leave a token for other lookups
+        if not get_rate_limiter(self.plugin).try_acquire(reserve=1):
+            return
+        with self.lock:
+            if self.closed:
+                return
+            interrupt = self._add_attempt()
+        get_tracer(self.plugin).count('hedged_fetch')
+        t = Thread(target=self._attempt, args=(interrupt,), name='BeamEbooksHedge')
+        t.daemon = True
+        t.start()
+
+    def _add_attempt(self):
+        interrupt = Interrupt()
+        self.attempts.append(interrupt)
+        self.running += 1
+        return interrupt
+
+    def _attempt(self, interrupt):
+        try:
+            response = get_transport(self.plugin).open(self.url, timeout=self.timeout,
+                    abort=interrupt)
+            raw = self.read(response, interrupt) if response is not None else None
+            if interrupt.is_set():
+                # Cut short, the body may be incomplete
+                raw = None
+            self.results.put((response.geturl() if raw is not None else None, raw, None))
+            if raw is not None:
+                self._interrupt()
+        except Exception as e:
+            self.results.put((None, None, e))
+
+    def _interrupt(self):
+        with self.lock:
+            attempts = list(self.attempts)
+        for interrupt in attempts:
+            interrupt.fire()
+
+class HedgeTimer(object):
+
+    '''
+    A single thread that looks after every :class:`HedgedFetch` in flight:
+    it starts their hedges once the hedge delay has passed, and cuts them
+    short when their abort is set. The thread ends once there is nothing
+    left to watch, the next watch() starts a new one.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.fetches = set()
+        self.thread = None
+
+    def watch(self, fetch):
+        with self.lock:
+            self.fetches.add(fetch)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name='BeamEbooksHedgeTimer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unwatch(self, fetch):
+        with self.lock:
+            self.fetches.discard(fetch)
+
+    def _run(self):
+        while True:
+            time.sleep(ABORT_CHECK_INTERVAL)
+            with self.lock:
+                if not self.fetches:
+                    self.thread = None
+                    return
+                fetches = list(self.fetches)
+            for fetch in fetches:
+                try:
+                    fetch.check()
+                except:
+                    # The next check tries again, the timer must keep
+                    # running for the other downloads
+                    pass
+
+_hedge_timer = HedgeTimer()
+
+def get_hedge_timer():
+    return _hedge_timer
+
+def shared_fetch(plugin, url, timeout, abort, phase, rate_limit=True,
+                 read=read_response):
+    '''
+    :func:`hedged_fetch` behind the rate limiter, shared by every caller
+    asking for url at the same time: only the first one waits for a token
+    and sends the request, the others get its answer. The download is
+    traced as phase. Pass rate_limit=False if the caller took the token
+    already.
+    '''
+    tracer = get_tracer(plugin)
+
+    def fetch():
+        if rate_limit:
+            with tracer.phase('rate_wait'):
+                if not get_rate_limiter(plugin).acquire(abort):
+                    return None
+        with tracer.phase(phase):
+            return hedged_fetch(plugin, url, timeout, abort, read)
+
+    return get_single_flight().do(url, fetch, abort)
+
+class Worker(object): # Get details
+
+    '''
+    Get book details from Beam Ebooks book page, run by the shared worker pool
+    '''
+
+    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20,
+                 abort=None, completion=None, exact=False, background=False):
+        self.abort = abort if abort is not None else Event()
+        self.completion = completion
+        # Set for the page of a known beam ebooks id, which outranks any
+        # other candidate once it has been parsed
+        self.exact = exact
+        # Set when the prefetcher or the library refresh runs this worker,
+        # they take rate limiter tokens themselves and must not start any
+        # prefetching
+        self.background = background
         self.url = url
         self.result_queue = result_queue
         self.log = log
         self.timeout = timeout
         self.relevance = relevance
         self.plugin = plugin
-        self.browser = browser.clone_browser()
+        self.tracer = get_tracer(plugin)
+        # Downloads go through the shared connection pool, browser is only
+        # kept for callers that still pass one
+        self.browser = browser
         self.cover_url = None
         self.beam_ebooks_id = None
 
     def run(self):
-        self.log.info("    Worker.run: self: ", self)
         try:
-            self.get_details()
+            if not self.abort.is_set():
+                self.get_details()
         except:
             self.log.exception('get_details failed for url: %r' % self.url)
+        finally:
+            if self.completion is not None:
+                self.completion.finished()
 
     def get_details(self):
-        self.log.info("    Worker.get_details:")
-        self.log.info("        self:     ", self)
-        self.log.info("        self.url: ", self.url)
-        
         # We should not even be here if we are not processing an ebook hit
         if self.url.find("/ebook/") == -1:
             return
 
-        try:
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
-        except Exception as e:
-            if callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
-                self.log.error('URL malformed: %r' % self.url)
+        raw = self.cached_details()
+        if raw is None:
+            if self.known_missing():
                 return
-            attr = getattr(e, 'args', [None])
-            attr = attr if attr else [None]
-            if isinstance(attr[0], socket.timeout):
-                msg = 'Beam Ebooks timed out. Try again later.'
-                self.log.error(msg)
-            else:
-                msg = 'Failed to make details query: %r' % self.url
+            raw = self.download_details()
+            if raw is None:
+                return
+            self.store_details(raw)
+        self.process_details(raw)
+
+    def cached_details(self):
+        '''
+        The details page from the details cache, or None if it has to be
+        downloaded
+        '''
+        try:
+            self.beam_ebooks_id = self.parse_beam_ebooks_id(self.url)
+        except:
+            self.log.exception('Error parsing beam ebooks id for url: %r' % self.url)
+            self.beam_ebooks_id = None
+
+        raw = None
+        if self.beam_ebooks_id:
+            try:
+                raw = get_details_cache(self.plugin).get(self.beam_ebooks_id)
+            except:
+                self.log.exception('Error reading the details cache, downloading: %r' % self.url)
+        self.tracer.count('details_cache_miss' if raw is None else 'details_cache_hit')
+        return raw
+
+    def known_missing(self):
+        '''
+        True if the site answered the last request for this book with its
+        404 page
+        '''
+        if not self.beam_ebooks_id:
+            return False
+        try:
+            missing = get_missing_cache(self.plugin).get(self.beam_ebooks_id) is not None
+        except:
+            self.log.exception('Error reading the cache of missing ids: %r' % self.url)
+            return False
+        if missing:
+            self.tracer.count('known_missing')
+            self.log.error('URL malformed (remembered): %r' % self.url)
+        return missing
+
+    def mark_missing(self):
+        self.log.error('URL malformed: %r' % self.url)
+        if self.beam_ebooks_id:
+            try:
+                get_missing_cache(self.plugin).put(self.beam_ebooks_id, '')
+            except:
+                self.log.exception('Error writing the cache of missing ids: %r' % self.url)
+
+    def store_details(self, raw):
+        if self.beam_ebooks_id:
+            try:
+                get_details_cache(self.plugin).put(self.beam_ebooks_id, raw)
+            except:
+                self.log.exception('Error writing the details cache: %r' % self.url)
+
+    def process_details(self, raw):
+        '''
+        Parses the details page and puts the Metadata built from it on the
+        result queue
+        '''
+        with self.tracer.phase('parse'):
+            try:
+                # root = fromstring(clean_ascii_chars(raw))
+                root = fromstring(raw)
+            except:
+                msg = 'Failed to parse beam ebooks details page: %r' % self.url
                 self.log.exception(msg)
-            return
+                return
+            self.parse_details(root)
+            self.cover_url = self.parse_cover_url(root)
 
-        # raw = raw.decode('utf-8', errors='replace')
-        raw = raw.decode('iso-8859-1', errors='replace')
-        # open('D:\\work\\calibre-dump-book-details.html', 'wb').write(raw)
+        with self.tracer.phase('metadata_build'):
+            mi = self.build_metadata()
+        self.result_queue.put(mi)
+        if self.exact and self.completion is not None:
+            self.completion.resolve()
 
-        if '<title>404 - ' in raw:
-            self.log.error('URL malformed: %r' % self.url)
-            return
 
+    def download_details(self):
         try:
-            # root = fromstring(clean_ascii_chars(raw))
-            root = fromstring(raw)
-        except:
-            msg = 'Failed to parse beam ebooks details page: %r' % self.url
-            self.log.exception(msg)
+            fetched = shared_fetch(self.plugin, self.url, self.timeout, self.abort,
+                    'details_fetch', rate_limit=not self.background,
+                    read=read_details)
+            if fetched is None:
+                return None
+            raw = fetched[1]
+        except Exception as e:
+            self.download_failed(e, traceback=True)
+            return None
+        return self.decode_details(raw)
+
+    def download_failed(self, e, traceback=False):
+        '''
+        Logs why the details page could not be downloaded
+        '''
+        if callable(getattr(e, 'getcode', None)) and e.getcode() == 404:
+            self.mark_missing()
+            return
+        if isinstance(e, CircuitOpen):
+            self.log.error('%s, skipped: %r' % (e, self.url))
             return
+        attr = getattr(e, 'args', [None])
+        attr = attr if attr else [None]
+        if isinstance(e, socket.timeout) or isinstance(attr[0], socket.timeout):
+            msg = 'Beam Ebooks timed out. Try again later.'
+            self.log.error(msg)
+        elif traceback:
+            msg = 'Failed to make details query: %r' % self.url
+            self.log.exception(msg)
+        else:
+            self.log.error('Failed to make details query: %r (%s)' % (self.url, e))
+
+    def decode_details(self, raw):
+        '''
+        The downloaded details page as unicode, or None if the site
+        answered with its page for unknown books
+        '''
+        with self.tracer.phase('decode'):
+            # raw = raw.decode('utf-8', errors='replace')
+            raw = raw.strip().decode('iso-8859-1', errors='replace')
+        # open('D:\\work\\calibre-dump-book-details.html', 'wb').write(raw)
 
-        try:
-            self.beam_ebooks_id = self.parse_beam_ebooks_id(self.url)
-        except:
-            self.log.exception('Error parsing beam ebooks id for url: %r' % self.url)
-            self.beam_ebooks_id = None
+        if '<title>404 - ' in raw:
+            self.mark_missing()
+            return None
+
+        return raw
 
+
+    def parse_details(self, root):
         try:
-            (self.title, self.series_index) = self.parse_title(root)
+            (self.title, self.series_index, self.authors) = self.extract_details(root)
         except:
-            self.log.exception('Error parsing title for url: %r' % self.url)
+            self.log.exception('Error parsing details for url: %r' % self.url)
             self.title = None
             self.series_index = None
-
-        try:
-            self.authors = self.parse_authors(root)
-        except:
-            self.log.exception('Error parsing authors for url: %r' % self.url)
             self.authors = None
 
+
+    def build_metadata(self):
         mi = Metadata(self.title, self.authors)
         mi.set_identifier('beam-ebooks', self.beam_ebooks_id)
 
@@ -111,13 +560,34 @@ class Worker(Thread): # Get details
             mi.series_index = float(self.series_index)
         
         self._determine_perry_rhodan_cycle_name(mi)
+        if mi.series and mi.series.startswith('Perry Rhodan') and not self.background:
+            from calibre_plugins.beam_ebooks_metadata.prefetch import get_prefetcher
+            prefetcher = get_prefetcher(self.plugin)
+            if prefetcher is not None:
+                prefetcher.issue_resolved(self.log, int(mi.series_index))
 
         mi.source_relevance = self.relevance
 
+        if self.beam_ebooks_id and self.cover_url:
+            mi.has_cover = True
+            self.plugin.cache_identifier_to_cover_url(self.beam_ebooks_id, self.cover_url)
+
         self.plugin.clean_downloaded_metadata(mi)
 
-        print(mi)
-        self.result_queue.put(mi)        
+        if use_catalog(self.plugin):
+            try:
+                get_catalog().add_metadata(mi)
+            except:
+                disable_catalog(self.log)
+
+        return mi
+
+
+    def parse_cover_url(self, root):
+        sources = COVER_XPATH(root)
+        if not sources:
+            return None
+        return urljoin(self.url, sources[0].strip())
 
 
     def parse_beam_ebooks_id(self, url):
@@ -125,153 +595,35 @@ class Worker(Thread): # Get details
 
 
     def parse_title(self, root):
-        title = None
-        series_index = None
-
-        nodes = root.xpath('//tr/td/div/h1/strong')
+        nodes = TITLE_XPATH(root)
         if not nodes:
-            print("Title pattern, no title line found")
-        else:
-            for i, node in enumerate(nodes):
-                # print("Title pattern %s content %s " % (i, node.text_content().strip()))
-                title = node.text_content().strip()
+            return (None, None)
+        return self._munge_title(nodes[0].text_content().strip())
 
-        # TODO: title munging should be configurable
-        pr_series_title = " - Perry Rhodan "
-        index_of_pr = title.find(pr_series_title)
-        if index_of_pr > -1:
-            prefix = title[:index_of_pr]
-            print("    Prefix: '%s'" % (prefix))
-            index_of_pr = index_of_pr + len(pr_series_title)
-            series_index = title[index_of_pr:]
-            while len(series_index) < 4:
-                series_index = "0" + series_index
-            print("    Series Index: '%s'" % (series_index))
-            title = "PR" + series_index + " - " + prefix
-
-        pr_series_title = "PERRY RHODAN-Heftroman "
-        index_of_pr = title.find(pr_series_title)
-        if index_of_pr > -1:
-            index_of_pr = index_of_pr + len(pr_series_title)
-            # TODO: Test this again with a three-digit issue number
-            index_of_pr = index_of_pr + 6
-            postfix = title[index_of_pr:]
-            print("    Postfix: '%s'" % (postfix))
-            series_index = title[:index_of_pr]
-            print("    Series-Index-1: '%s'" % (series_index))
-            series_index = series_index[len(series_index) - 6 : len(series_index) - 2]
-            print("    Series-Index-2: '%s'" % (series_index))
-            title = "PR" + series_index + " - " + postfix
-
-        if title != None:
-            # print("Plain '%s'" % title)
-            # print("UTF-8 '%s'" % title.encode('utf-8'))
-            # title = title.encode('utf-8')
-            title = title.decode('utf-8')
-            # title = title.decode('iso-8859-1')
-            # title = title.encode('iso-8859-1')
 
-        return (title, series_index)
+    def parse_authors(self, root):
+        return [node.text_content().strip() for node in AUTHORS_XPATH(root)]
 
 
-    def parse_authors(self, root):
-        authors = []
+    def extract_details(self, root):
+        (title, authors) = extract_details(root)
+        if title is None:
+            return (None, None, authors)
+        (title, series_index) = self._munge_title(title)
+        return (title, series_index, authors)
 
-        nodes = root.xpath('//tr/td/p/a')
-        if not nodes:
-            print("Authors pattern 1, no authors line found")
-        else:
-            for i, node in enumerate(nodes):
-                url = node.get('href').strip()
-                # print("Authors pattern %s content %s, %s " % (i, node.text_content().strip(), url))
-                if url.find('/autoreninfo.php') > -1:
-                    author = node.text_content().strip()
-                    authors.append(author)
-
-        nodes = root.xpath('//tr/td/a')
-        if not nodes:
-            print("Authors pattern 2, no authors line found")
-        else:
-            for i, node in enumerate(nodes):
-                url = node.get('href').strip()
-                # print("Authors pattern %s content %s, %s " % (i, node.text_content().strip(), url))
-                if url.find('/autoreninfo.php') > -1:
-                    author = node.text_content().strip()
-                    authors.append(author)
 
-        return authors
+    def _munge_title(self, title):
+        # lxml hands out plain ASCII text as str
+        if isinstance(title, bytes):
+            title = title.decode('utf-8')
+        # Rewrites the Perry Rhodan conventions of the site to PRnnnn - Title,
+        # see titles.DETAILS_RULES
+        return get_details_rules(self.plugin, self.log).apply(title)
 
     def _determine_perry_rhodan_cycle_name(self, mi):
-        if self.title.find("PR") == 0 and self.series_index > 0:
+        if self.title and self.title.find("PR") == 0 and mi.series_index > 0:
             mi.series = "Perry Rhodan"
-            if mi.series_index >= 1 and mi.series_index <= 49:
-                mi.series = "Perry Rhodan, Die dritte Macht"
-            if mi.series_index >= 50 and mi.series_index <= 99:
-                mi.series = "Perry Rhodan, Atlan und Arkon"
-            if mi.series_index >= 100 and mi.series_index <= 149:
-                mi.series = "Perry Rhodan, Die Posbis"
-            if mi.series_index >= 150 and mi.series_index <= 199:
-                mi.series = "Perry Rhodan, Das zweite Imperium"
-            if mi.series_index >= 200 and mi.series_index <= 299:
-                mi.series = "Perry Rhodan, Die Meister der Insel"
-            if mi.series_index >= 300 and mi.series_index <= 399:
-                mi.series = "Perry Rhodan, M 87"
-            if mi.series_index >= 400 and mi.series_index <= 499:
-                mi.series = "Perry Rhodan, Die Cappins"
-            if mi.series_index >= 500 and mi.series_index <= 569:
-                mi.series = "Perry Rhodan, Der Schwarm"
-            if mi.series_index >= 570 and mi.series_index <= 599:
-                mi.series = "Perry Rhodan, Die Altmutanten"
-            if mi.series_index >= 600 and mi.series_index <= 649:
-                mi.series = "Perry Rhodan, Das kosmische Schachspiel"
-            if mi.series_index >= 650 and mi.series_index <= 699:
-                mi.series = "Perry Rhodan, Das Konzil"
-            if mi.series_index >= 700 and mi.series_index <= 799:
-                mi.series = "Perry Rhodan, Die Aphilie"
-            if mi.series_index >= 800 and mi.series_index <= 867:
-                mi.series = "Perry Rhodan, Bardioc"
-            if mi.series_index >= 868 and mi.series_index <= 899:
-                mi.series = "Perry Rhodan, PAN-THAU-RA"
-            if mi.series_index >= 900 and mi.series_index <= 999:
-                mi.series = "Perry Rhodan, Die Kosmischen Burgen"
-            if mi.series_index >= 1000 and mi.series_index <= 1099:
-                mi.series = "Perry Rhodan, Die Kosmische Hanse"
-            if mi.series_index >= 1100 and mi.series_index <= 1199:
-                mi.series = "Perry Rhodan, Die Endlose Armada"
-            if mi.series_index >= 1200 and mi.series_index <= 1299:
-                mi.series = "Perry Rhodan, Chronofossilien"
-            if mi.series_index >= 1300 and mi.series_index <= 1349:
-                mi.series = "Perry Rhodan, Die Gänger des Netzes"
-            if mi.series_index >= 1400 and mi.series_index <= 1499:
-                mi.series = "Perry Rhodan, Die Cantaro"
-            if mi.series_index >= 1500 and mi.series_index <= 1599:
-                mi.series = "Perry Rhodan, Die Linguiden"
-            if mi.series_index >= 1600 and mi.series_index <= 1649:
-                mi.series = "Perry Rhodan, Die Ennox"
-            if mi.series_index >= 1650 and mi.series_index <= 1699:
-                mi.series = "Perry Rhodan, Die Große Leere"
-            if mi.series_index >= 1700 and mi.series_index <= 1749:
-                mi.series = "Perry Rhodan, Die Ayindi"
-            if mi.series_index >= 1800 and mi.series_index <= 1875:
-                mi.series = "Perry Rhodan, Die Tolkander"
-            if mi.series_index >= 1876 and mi.series_index <= 1899:
-                mi.series = "Perry Rhodan, Die Heliotischen Bollwerke"
-            if mi.series_index >= 1900 and mi.series_index <= 1949:
-                mi.series = "Perry Rhodan, Der Sechste Bote"
-            if mi.series_index >= 1950 and mi.series_index <= 1999:
-                mi.series = "Perry Rhodan, MATERIA"
-            if mi.series_index >= 2000 and mi.series_index <= 2099:
-                mi.series = "Perry Rhodan, Die Solare Residenz"
-            if mi.series_index >= 2100 and mi.series_index <= 2199:
-                mi.series = "Perry Rhodan, Das Reich Tradom"
-            if mi.series_index >= 2200 and mi.series_index <= 2299:
-                mi.series = "Perry Rhodan, Der Sternenozean"
-            if mi.series_index >= 2300 and mi.series_index <= 2399:
-                mi.series = "Perry Rhodan, TERRANOVA"
-            if mi.series_index >= 2400 and mi.series_index <= 2499:
-                mi.series = "Perry Rhodan, Negaspähre"
-            if mi.series_index >= 2500 and mi.series_index <= 2599:
-                mi.series = "Perry Rhodan, Stardust"
-            elif mi.series_index >= 2600 and mi.series_index < 2699:
-                mi.series = "Perry Rhodan, Neuroversum"
-
+            cycle = get_series_index(self.plugin).cycle(mi.series, mi.series_index)
+            if cycle is not None:
+                mi.series = "%s, %s" % (mi.series, cycle)